@@ -1,10 +1,33 @@
 # admin.py
 from flask import Blueprint, request, jsonify
-from sqlalchemy import text
-from app import db  # assuming your main app sets up the SQLAlchemy instance as db
+from extensions import db
+from errors import error_response
+from exports import export_stats
+from leaderboard import leaderboard
+from admission import controller
+from analytics import analytics
+from availability import allocator
+from customer_search import customer_index
+from pool_metrics import pool_status
+from purge import purger
+from queries import Statement, registry
+from rental_rollup import rollup
+from routing import router
+from singleflight import actor_flight, film_flight, search_flight
+from response_cache import actor_cache, film_cache
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
 
+LOGIN_QUERY = Statement(
+    "admin.login",
+    "SELECT * FROM film_store.admin_users WHERE username = :username AND password = :password",
+)
+
+ADD_ADMIN_QUERY = Statement(
+    "admin.add",
+    "INSERT INTO film_store.admin_users (username, password) VALUES (:username, :password)",
+)
+
 @admin_bp.route('/login', methods=['POST'])
 def admin_login():
     data = request.get_json()
@@ -15,8 +38,7 @@ def admin_login():
         return jsonify({"error": "Username and password are required"}), 400
     
     # Query the admin_users table in the admin_db database
-    query = text("SELECT * FROM film_store.admin_users WHERE username = :username AND password = :password")
-    result = db.session.execute(query, {"username": username, "password": password}).mappings().fetchone()
+    result = LOGIN_QUERY.execute(db.session, {"username": username, "password": password}).mappings().fetchone()
     
     if result:
         return jsonify({"message": "Login successful", "admin": dict(result)})
@@ -33,11 +55,91 @@ def add_admin():
         return jsonify({"error": "Username and password required"}), 400
 
     try:
-        insert_query = text("INSERT INTO film_store.admin_users (username, password) VALUES (:username, :password)")
-        db.session.execute(insert_query, {"username": username, "password": password})
+        ADD_ADMIN_QUERY.execute(db.session, {"username": username, "password": password})
         db.session.commit()
         return jsonify({"message": "New admin account created successfully."}), 201
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+@admin_bp.route('/leaderboard', methods=['GET'])
+def leaderboard_stats():
+    """Report landing page leaderboard staleness and hit/miss counters."""
+    return jsonify(leaderboard.stats())
+
+
+@admin_bp.route('/customer-search', methods=['GET'])
+def customer_search_stats():
+    """Report customer typeahead index size and search latency."""
+    return jsonify(customer_index.stats())
+
+
+@admin_bp.route('/inventory', methods=['GET'])
+def inventory_stats():
+    """Report free-list sizes and allocation counters for rentals."""
+    return jsonify(allocator.stats())
+
+
+@admin_bp.route('/pool', methods=['GET'])
+def pool_stats():
+    """Report database connection pool usage, wait times and timeouts."""
+    return jsonify(pool_status(db.engine))
+
+
+@admin_bp.route('/replicas', methods=['GET'])
+def replica_stats():
+    """Report replica health, read routing counters and replica pools."""
+    stats = router.stats()
+    for key, replica in stats["replicas"].items():
+        replica["pool"] = pool_status(db.engines[key])
+    return jsonify(stats)
+
+
+@admin_bp.route('/response-cache', methods=['GET'])
+def response_cache_stats():
+    """Report hit/miss counters for the cached film and actor responses."""
+    return jsonify({"film": film_cache.stats(), "actor": actor_cache.stats()})
+
+
+@admin_bp.route('/admission', methods=['GET'])
+def admission_stats():
+    """Report queue depths, waits and rejections of limited endpoints."""
+    return jsonify(controller.stats())
+
+
+@admin_bp.route('/single-flight', methods=['GET'])
+def single_flight_stats():
+    """Report executions and SQL statements saved by request coalescing."""
+    return jsonify({flight.name: flight.stats()
+                    for flight in (film_flight, actor_flight, search_flight)})
+
+
+@admin_bp.route('/rental-rollup', methods=['GET'])
+def rental_rollup_stats():
+    """Report whether the rental count rollup is in use."""
+    return jsonify(rollup.stats())
+
+
+@admin_bp.route('/rental-analytics', methods=['GET'])
+def rental_analytics_stats():
+    """Report whether the rental activity rollups are being maintained."""
+    return jsonify(analytics.stats())
+
+
+@admin_bp.route('/exports', methods=['GET'])
+def export_stats_report():
+    """Report rows exported and throughput of recent exports."""
+    return jsonify(export_stats.stats())
+
+
+@admin_bp.route('/customer-purge', methods=['GET'])
+def customer_purge_stats():
+    """Report purge jobs run by this worker and the longest chunk."""
+    return jsonify(purger.stats())
+
 
+@admin_bp.route('/queries', methods=['GET'])
+def query_stats():
+    """Report executions and compiled variants of each registered statement."""
+    return jsonify(registry.stats())
@@ -0,0 +1,292 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, jsonify, request
+
+import instrumentation
+from instrumentation import LATENCY_BUCKETS, Counter, Gauge, Histogram
+
+DEFAULT_QUEUE_TIMEOUT_MS = 500
+DEFAULT_READ_THREADS = 6
+DEFAULT_READ_CONNECTIONS = 16
+DEFAULT_BURST = 20
+# Token buckets kept for this many clients, least recently seen dropped
+MAX_CLIENTS = 10000
+
+READ_METHODS = frozenset({"GET", "HEAD"})
+
+queue_depth = Gauge(
+    "admission_queue_depth", "Requests waiting for a slot, by route."
+)
+active_requests = Gauge(
+    "admission_active_requests", "Requests holding a slot, by route."
+)
+queue_wait = Histogram(
+    "admission_queue_wait_seconds", "Time admitted requests waited.",
+    LATENCY_BUCKETS,
+)
+rejections = Counter(
+    "admission_rejections_total",
+    "Requests shed by admission control, by route and reason.",
+)
+instrumentation.register(queue_depth, active_requests, queue_wait, rejections)
+
+
+class Rejected(Exception):
+    """A request that was shed; answered with status and Retry-After."""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RouteLimit:
+    """Concurrency limit and wait queue of one endpoint."""
+
+    def __init__(self, endpoint, limit, queue_size, connections):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.queue_size = queue_size
+        # Pool connections one request holds at once, fan-out included
+        self.connections = connections
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0, "rate_limited": 0}
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "connections": self.connections,
+            "active": self.active,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "mean_wait_ms": (round(self.wait_seconds / self.admitted * 1000, 3)
+                             if self.admitted else None),
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+        }
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate, burst, now):
+        """Spend a token; return 0, or the seconds until one is available."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionController:
+    """Bounds how many expensive reads run at once.
+
+    Each limited endpoint has a concurrency limit and a bounded queue. All
+    of them together may hold read_threads of the worker's threads, running
+    or waiting, so the rest are always free for writes and other routes,
+    and read_connections pool connections, counting each request as the
+    connections its endpoint fans out to. A request that finds its route
+    busy waits in the queue up to QUEUE_TIMEOUT and is shed with a 503 if
+    it is still waiting then, or straight away if the queue is full or no
+    read thread is left to wait in. With a rate configured, each client
+    also has a token bucket per worker for the limited endpoints, and is
+    answered 429 once it is empty. Writes and other routes are never queued
+    or rate limited.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self.routes = {}
+        self.read_threads = DEFAULT_READ_THREADS
+        self.read_connections = DEFAULT_READ_CONNECTIONS
+        self.active_reads = 0
+        self.queued_reads = 0
+        self.active_connections = 0
+        self.queue_timeout = DEFAULT_QUEUE_TIMEOUT_MS / 1000
+        self.rate = 0
+        self.burst = DEFAULT_BURST
+        self.buckets = OrderedDict()
+
+    def configure(self, limits, queue_size, queue_timeout, read_threads,
+                  read_connections, connections, rate, burst):
+        # Waiting requests hold threads too
+        queue_size = min(queue_size, read_threads)
+        with self._lock:
+            self.routes = {
+                endpoint: RouteLimit(endpoint, limit, queue_size,
+                                     connections.get(endpoint, 1))
+                for endpoint, limit in limits.items() if limit
+            }
+            self.queue_timeout = queue_timeout
+            self.read_threads = read_threads
+            # Else a request to the widest endpoint could never run
+            self.read_connections = max(
+                [read_connections]
+                + [route.connections for route in self.routes.values()]
+            )
+            self.rate = rate
+            self.burst = burst
+
+    def _rate_limit(self, route, client, now):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.burst, now)
+            if len(self.buckets) > MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        wait = bucket.take(self.rate, self.burst, now)
+        if wait:
+            raise self._reject(route, 429, "rate_limited", math.ceil(wait))
+
+    def _has_room(self, route):
+        return (route.active < route.limit
+                and self.active_connections + route.connections
+                <= self.read_connections)
+
+    def _reject(self, route, status, reason, retry_after):
+        route.rejected[reason] += 1
+        rejections.inc((("route", route.endpoint), ("reason", reason)))
+        return Rejected(status, reason, retry_after)
+
+    def _gauges(self, route):
+        labels = (("route", route.endpoint),)
+        queue_depth.set(labels, route.queued)
+        active_requests.set(labels, route.active)
+
+    def acquire(self, endpoint, client, retry_after):
+        """
+        Take a slot for a request to endpoint, waiting for one if needed.
+        Returns False for endpoints without a limit and raises Rejected
+        when the request is shed.
+        """
+        route = self.routes.get(endpoint)
+        if route is None:
+            return False
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        with self._room:
+            if self.rate:
+                self._rate_limit(route, client, started)
+            if self.active_reads + self.queued_reads >= self.read_threads:
+                raise self._reject(route, 503, "queue_full", retry_after)
+            if not self._has_room(route):
+                if route.queued >= route.queue_size:
+                    raise self._reject(route, 503, "queue_full", retry_after)
+                route.queued += 1
+                self.queued_reads += 1
+                route.max_queued = max(route.max_queued, route.queued)
+                self._gauges(route)
+                try:
+                    while not self._has_room(route):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._reject(route, 503, "timeout",
+                                               retry_after)
+                        self._room.wait(remaining)
+                finally:
+                    route.queued -= 1
+                    self.queued_reads -= 1
+                    self._gauges(route)
+            route.active += 1
+            self.active_reads += 1
+            self.active_connections += route.connections
+            waited = time.monotonic() - started
+            route.admitted += 1
+            route.wait_seconds += waited
+            route.max_wait_seconds = max(route.max_wait_seconds, waited)
+            self._gauges(route)
+        queue_wait.observe((("route", endpoint),), waited)
+        return True
+
+    def release(self, endpoint):
+        with self._room:
+            route = self.routes[endpoint]
+            route.active -= 1
+            self.active_reads -= 1
+            self.active_connections -= route.connections
+            self._gauges(route)
+            self._room.notify_all()
+
+    def stats(self):
+        """Return limits, queue depths, waits and rejections per route."""
+        with self._lock:
+            return {
+                "read_threads": self.read_threads,
+                "read_connections": self.read_connections,
+                "active_reads": self.active_reads,
+                "queued_reads": self.queued_reads,
+                "active_connections": self.active_connections,
+                "queue_timeout_ms": round(self.queue_timeout * 1000),
+                "rate_per_second": self.rate,
+                "burst": self.burst,
+                "clients": len(self.buckets),
+                "routes": {endpoint: route.stats()
+                           for endpoint, route in self.routes.items()},
+            }
+
+
+controller = AdmissionController()
+
+
+def _admit():
+    if request.method not in READ_METHODS or request.endpoint is None:
+        return None
+    retry_after = current_app.config.get("RETRY_AFTER_SECONDS", 1)
+    try:
+        if controller.acquire(request.endpoint, request.remote_addr,
+                              retry_after):
+            g.admitted_endpoint = request.endpoint
+    except Rejected as rejected:
+        message = ("Too many requests" if rejected.status == 429
+                   else "Server busy, try again shortly")
+        response = jsonify({"error": message})
+        response.status_code = rejected.status
+        response.headers["Retry-After"] = str(rejected.retry_after)
+        return response
+    return None
+
+
+def _release(exc):
+    endpoint = g.pop("admitted_endpoint", None)
+    if endpoint is not None:
+        controller.release(endpoint)
+
+
+def init_app(app):
+    """Limit the endpoints in ADMISSION_LIMITS; shed load beyond them."""
+    if not app.config.get("ADMISSION_CONTROL_ENABLED", True):
+        return
+    read_threads = app.config.get("ADMISSION_READ_THREADS",
+                                  DEFAULT_READ_THREADS)
+    controller.configure(
+        app.config.get("ADMISSION_LIMITS", {}),
+        app.config.get("ADMISSION_QUEUE_SIZE", read_threads),
+        app.config.get("ADMISSION_QUEUE_TIMEOUT_MS",
+                       DEFAULT_QUEUE_TIMEOUT_MS) / 1000,
+        read_threads,
+        app.config.get("ADMISSION_READ_CONNECTIONS",
+                       DEFAULT_READ_CONNECTIONS),
+        app.config.get("ADMISSION_CONNECTIONS", {}),
+        app.config.get("ADMISSION_RATE_PER_SECOND", 0),
+        app.config.get("ADMISSION_BURST", DEFAULT_BURST),
+    )
+    app.before_request(_admit)
+    app.teardown_request(_release)
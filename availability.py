@@ -0,0 +1,185 @@
+import threading
+import time
+
+from sqlalchemy import bindparam, text
+
+from queries import Statement
+
+# A sold-out film's free list is re-read from the database at most this
+# often, to pick up copies returned through other workers.
+SOLD_OUT_RECHECK_SECONDS = 1.0
+
+FREE_INVENTORY_QUERY = text("""
+    SELECT i.film_id, i.inventory_id FROM inventory i
+    LEFT JOIN rental r
+        ON i.inventory_id = r.inventory_id AND r.return_date IS NULL
+    WHERE i.film_id IN :film_ids AND r.inventory_id IS NULL
+""").bindparams(bindparam("film_ids", expanding=True))
+
+LOCK_INVENTORY_QUERY = Statement("inventory.lock", """
+    SELECT inventory_id FROM inventory
+    WHERE inventory_id IN :inventory_ids{for_update}
+""", expanding=["inventory_ids"], for_update=" FOR UPDATE")
+
+OPEN_RENTAL_QUERY = Statement("inventory.open_rentals", """
+    SELECT inventory_id FROM rental
+    WHERE inventory_id IN :inventory_ids AND return_date IS NULL{for_update}
+""", expanding=["inventory_ids"], for_update=" FOR UPDATE")
+
+
+def locking(session):
+    """Clauses that make a read a locking read where the database allows."""
+    if session.get_bind().dialect.name == "sqlite":
+        # SQLite has no row locks; its single writer serializes rentals.
+        return ()
+    return ("for_update",)
+
+
+class InventoryAllocator:
+    """Per-film free lists of inventory copies.
+
+    A film's free list is loaded with one anti-join the first time it is
+    rented (or whenever it runs dry) and is then maintained by allocation,
+    release() and the return path, so renting no longer scans open rentals.
+    The in-process lock stops two requests in this worker from taking the
+    same copy; allocation also locks the inventory rows and re-checks for
+    open rentals so copies taken by other workers are skipped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = {}
+        self._loaded_at = {}
+        self._held = set()
+        self.allocations = 0
+        self.conflicts = 0
+        self.reloads = 0
+
+    def _needs_load(self, film_id, now):
+        with self._lock:
+            if self._free.get(film_id):
+                return False
+            loaded_at = self._loaded_at.get(film_id)
+            return (loaded_at is None
+                    or now - loaded_at >= SOLD_OUT_RECHECK_SECONDS)
+
+    def _load(self, session, film_ids):
+        rows = session.execute(FREE_INVENTORY_QUERY, {"film_ids": film_ids})
+        free = {film_id: set() for film_id in film_ids}
+        for film_id, inventory_id in rows:
+            free[film_id].add(inventory_id)
+        now = time.monotonic()
+        with self._lock:
+            for film_id, copies in free.items():
+                # Copies allocated here whose rentals are not committed yet
+                # still look free to the anti-join
+                self._free[film_id] = copies - self._held
+                self._loaded_at[film_id] = now
+            self.reloads += 1
+
+    def _pop(self, film_id):
+        with self._lock:
+            free = self._free.get(film_id)
+            if not free:
+                return None
+            inventory_id = free.pop()
+            self._held.add(inventory_id)
+            return inventory_id
+
+    def allocate_many(self, session, film_ids):
+        """
+        Reserve one free copy per entry of film_ids inside the caller's
+        transaction. Returns a list of inventory_ids in the same order, with
+        None where every copy of that film is rented out. Free lists for all
+        the films are loaded, and the picked copies locked and checked, with
+        one query each. The caller must insert the rentals and then call
+        confirm() once it has committed, or release() if it gives up.
+        """
+        film_ids = [int(film_id) for film_id in film_ids]
+        allocated = [None] * len(film_ids)
+        pending = list(range(len(film_ids)))
+        reloaded = set()
+
+        while pending:
+            now = time.monotonic()
+            stale = {
+                film_ids[i] for i in pending
+                if film_ids[i] not in reloaded
+                and self._needs_load(film_ids[i], now)
+            }
+            if stale:
+                self._load(session, sorted(stale))
+                reloaded |= stale
+
+            picked = {}
+            for i in pending:
+                inventory_id = self._pop(film_ids[i])
+                if inventory_id is not None:
+                    picked[i] = inventory_id
+            if not picked:
+                break
+
+            params = {"inventory_ids": sorted(picked.values())}
+            try:
+                locked = {row[0] for row in LOCK_INVENTORY_QUERY.execute(
+                    session, params, include=locking(session)
+                )}
+                rented = {row[0] for row in OPEN_RENTAL_QUERY.execute(
+                    session, params, include=locking(session)
+                )}
+            except Exception:
+                # A lock wait timeout or deadlock; don't leave the copies
+                # held, or this worker never rents them again
+                for i, inventory_id in picked.items():
+                    self.release(film_ids[i], inventory_id)
+                for i, inventory_id in enumerate(allocated):
+                    if inventory_id is not None:
+                        self.release(film_ids[i], inventory_id)
+                raise
+
+            pending = []
+            with self._lock:
+                for i, inventory_id in picked.items():
+                    if inventory_id in locked and inventory_id not in rented:
+                        allocated[i] = inventory_id
+                        self.allocations += 1
+                    else:
+                        # Rented out by another worker since the free list
+                        # was loaded; try another copy
+                        self._held.discard(inventory_id)
+                        self.conflicts += 1
+                        pending.append(i)
+
+        return allocated
+
+    def allocate(self, session, film_id):
+        """Reserve a single copy of film_id; see allocate_many()."""
+        return self.allocate_many(session, [film_id])[0]
+
+    def confirm(self, *inventory_ids):
+        """Mark allocated copies' rentals as committed."""
+        with self._lock:
+            self._held.difference_update(inventory_ids)
+
+    def release(self, film_id, inventory_id):
+        """Put a copy back on its film's free list (rental returned/failed)."""
+        film_id = int(film_id)
+        with self._lock:
+            self._held.discard(inventory_id)
+            free = self._free.get(film_id)
+            if free is not None:
+                free.add(inventory_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "films_tracked": len(self._free),
+                "free_copies": sum(len(f) for f in self._free.values()),
+                "held": len(self._held),
+                "allocations": self.allocations,
+                "conflicts": self.conflicts,
+                "reloads": self.reloads,
+            }
+
+
+allocator = InventoryAllocator()
@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+def run_periodically(app, db, name, interval, func):
+    """Run func(session) every interval seconds in a thread.
+
+    The job is registered on the app and its thread is started by
+    start_all() when the worker process starts, so pre-fork servers don't
+    start threads in the master (they would not survive the fork). Each run
+    gets its own app context and session, so the job never shares a
+    connection with request handlers. Failures are logged and retried on
+    the next tick.
+    """
+    jobs = app.extensions.setdefault("background_jobs", [])
+    jobs.append((name, interval, func, db))
+    if app.extensions.get("background_started"):
+        _start(app, name, interval, func, db)
+
+
+def start_all(app):
+    """Start the threads of every job registered on app (once)."""
+    if app.extensions.get("background_started"):
+        return
+    app.extensions["background_started"] = True
+    for name, interval, func, db in app.extensions.get("background_jobs", []):
+        _start(app, name, interval, func, db)
+
+
+def _start(app, name, interval, func, db):
+    def loop():
+        while True:
+            with app.app_context():
+                try:
+                    func(db.session)
+                except Exception as e:
+                    app.logger.warning("%s failed: %s", name, e)
+                finally:
+                    db.session.remove()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
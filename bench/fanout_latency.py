@@ -0,0 +1,73 @@
+"""
+Sequential vs concurrent query benchmark for multi-query endpoints.
+
+Requests each endpoint repeatedly with QUERY_FANOUT_ENABLED off and on and
+prints the mean and p95 latency per mode as JSON lines. The landing page
+leaderboard is left unseeded so / exercises its SQL fallback.
+
+    python bench/fanout_latency.py --iterations 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture  # noqa: E402
+
+# Must run before app is imported
+if "--local" in sys.argv:
+    fixture.use_local_database(fixture.ensure())
+
+from wsgi import app  # noqa: E402
+import customers  # noqa: E402
+from leaderboard import leaderboard  # noqa: E402
+
+ENDPOINTS = [
+    "/",
+    "/film/1",
+    "/actor/1",
+    "/api/customers/?include_total=1",
+]
+
+
+def measure(client, path, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            raise RuntimeError(f"{path}: {response.get_json()}")
+    timings.sort()
+    return {
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--local", action="store_true",
+                        help="run against the scale 1 SQLite fixture")
+    args = parser.parse_args()
+
+    # Keep the leaderboard and customer count cache from hiding the queries
+    leaderboard.top_rented_films = leaderboard.top_actors = lambda: None
+    customers.COUNT_CACHE_SECONDS = 0
+
+    client = app.test_client()
+    for path in ENDPOINTS:
+        for enabled in (False, True):
+            app.config["QUERY_FANOUT_ENABLED"] = enabled
+            result = measure(client, path, args.iterations)
+            result.update(path=path, fanout=enabled)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
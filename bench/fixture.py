@@ -0,0 +1,396 @@
+"""
+Sakila-shaped SQLite fixture for running the app without MySQL.
+
+build() writes a database with the tables, columns and indexes the app
+queries, filled with deterministic synthetic data. Scale 1 matches the row
+counts of stock Sakila; customers, addresses, inventory, rentals and
+payments grow linearly with the scale while the film catalog stays fixed.
+
+use_local_database() points the app at such a file. It must be called
+before `app` is imported, and registers the MySQL functions the queries
+use (NOW, LAST_INSERT_ID, ST_GeomFromText) on every SQLite connection.
+
+    python bench/fixture.py --scale 10
+"""
+import argparse
+import atexit
+import datetime
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "sakila-x{scale}.db")
+
+# Row counts of stock Sakila
+FILMS = 1000
+ACTORS = 200
+FILM_ACTORS_PER_FILM = 5
+CUSTOMERS = 599
+INVENTORY = 4581
+RENTALS = 16044
+STORES = 2
+CITIES = 600
+
+CATEGORIES = [
+    "Action", "Animation", "Children", "Classics", "Comedy", "Documentary",
+    "Drama", "Family", "Foreign", "Games", "Horror", "Music", "New",
+    "Sci-Fi", "Sports", "Travel",
+]
+WORDS = [
+    "ACADEMY", "ACE", "ADAPTATION", "AFFAIR", "AFRICAN", "AGENT", "AIRPLANE",
+    "ALADDIN", "ALAMO", "ALASKA", "ALI", "ALIEN", "ALLEY", "AMADEUS",
+    "AMELIE", "AMERICAN", "ANACONDA", "ANGELS", "ANNIE", "ANONYMOUS",
+    "ANTHEM", "ANTITRUST", "ANYTHING", "APACHE", "APOCALYPSE", "ARABIA",
+    "ARMAGEDDON", "ARMY", "ARSENIC", "ARTIST", "ATLANTIS", "ATTACKS",
+    "BABY", "BACKLASH", "BADMAN", "BAKED", "BALLOON", "BANG", "BEACH",
+    "BEAR", "BEAST", "BED", "BEHAVIOR", "BENEATH", "BERETS", "BILKO",
+    "BIRDS", "BLADE", "BLANKET", "BLINDNESS", "BLOOD", "BLUES", "BOILED",
+    "BONNIE", "BOOGIE", "BORN", "BOULEVARD", "BOUND", "BOWFINGER", "BRAVE",
+    "CAMPUS", "CANDIDATE", "CANYON", "CAPER", "CARIBBEAN", "CASPER",
+    "CHAMBER", "CHICAGO", "CIRCUS", "CLUELESS", "DINOSAUR", "DOCTOR",
+    "DRAGON", "DUCK", "EGG", "ELEPHANT", "EXPRESS", "FANTASY", "FIDDLER",
+    "FLIGHT", "GHOST", "GOLDFINGER", "GRAFFITI", "HARRY", "HOLIDAY",
+]
+FIRST_NAMES = [
+    "MARY", "PATRICIA", "LINDA", "BARBARA", "ELIZABETH", "JENNIFER", "MARIA",
+    "SUSAN", "MARGARET", "DOROTHY", "LISA", "NANCY", "KAREN", "BETTY",
+    "HELEN", "SANDRA", "DONNA", "CAROL", "RUTH", "SHARON", "JAMES", "JOHN",
+    "ROBERT", "MICHAEL", "WILLIAM", "DAVID", "RICHARD", "CHARLES", "JOSEPH",
+    "THOMAS", "PENELOPE", "NICK", "ED", "JENNIFER", "JOHNNY", "BETTE",
+]
+LAST_NAMES = [
+    "SMITH", "JOHNSON", "WILLIAMS", "JONES", "BROWN", "DAVIS", "MILLER",
+    "WILSON", "MOORE", "TAYLOR", "ANDERSON", "THOMAS", "JACKSON", "WHITE",
+    "HARRIS", "MARTIN", "THOMPSON", "GARCIA", "MARTINEZ", "ROBINSON",
+    "GUINESS", "WAHLBERG", "CHASE", "DAVIS", "LOLLOBRIGIDA", "NICHOLSON",
+]
+
+SCHEMA = """
+CREATE TABLE language (
+    language_id INTEGER PRIMARY KEY, name TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE category (
+    category_id INTEGER PRIMARY KEY, name TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE film (
+    film_id INTEGER PRIMARY KEY, title TEXT NOT NULL, description TEXT,
+    release_year INTEGER, language_id INTEGER NOT NULL, rating TEXT,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE actor (
+    actor_id INTEGER PRIMARY KEY, first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE film_actor (
+    actor_id INTEGER NOT NULL, film_id INTEGER NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (actor_id, film_id));
+CREATE TABLE film_category (
+    film_id INTEGER NOT NULL, category_id INTEGER NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (film_id, category_id));
+CREATE TABLE store (
+    store_id INTEGER PRIMARY KEY,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE city (
+    city_id INTEGER PRIMARY KEY, city TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE inventory (
+    inventory_id INTEGER PRIMARY KEY, film_id INTEGER NOT NULL,
+    store_id INTEGER NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE address (
+    address_id INTEGER PRIMARY KEY, address TEXT NOT NULL, address2 TEXT,
+    district TEXT NOT NULL, city_id INTEGER NOT NULL, postal_code TEXT,
+    phone TEXT NOT NULL, location BLOB,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE customer (
+    customer_id INTEGER PRIMARY KEY, store_id INTEGER NOT NULL,
+    first_name TEXT NOT NULL, last_name TEXT NOT NULL, email TEXT,
+    address_id INTEGER NOT NULL, active INTEGER NOT NULL DEFAULT 1,
+    create_date TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE rental (
+    rental_id INTEGER PRIMARY KEY, rental_date TEXT NOT NULL,
+    inventory_id INTEGER NOT NULL, customer_id INTEGER NOT NULL,
+    return_date TEXT, staff_id INTEGER NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE payment (
+    payment_id INTEGER PRIMARY KEY, customer_id INTEGER NOT NULL,
+    staff_id INTEGER NOT NULL, rental_id INTEGER, amount NUMERIC NOT NULL,
+    payment_date TEXT NOT NULL,
+    last_update TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE admin_users (
+    id INTEGER PRIMARY KEY, username TEXT NOT NULL, password TEXT NOT NULL);
+CREATE TABLE fixture_info (scale INTEGER NOT NULL, seed INTEGER NOT NULL);
+
+CREATE INDEX idx_film_actor_film ON film_actor (film_id);
+CREATE INDEX idx_film_category_category ON film_category (category_id);
+CREATE INDEX idx_inventory_film ON inventory (film_id, store_id);
+CREATE INDEX idx_customer_last_name ON customer (last_name);
+CREATE INDEX idx_customer_address ON customer (address_id);
+CREATE INDEX idx_rental_inventory ON rental (inventory_id);
+CREATE INDEX idx_rental_customer ON rental (customer_id);
+CREATE INDEX idx_rental_date ON rental (rental_date, inventory_id, customer_id);
+CREATE INDEX idx_payment_customer ON payment (customer_id);
+CREATE INDEX idx_payment_rental ON payment (rental_id);
+"""
+
+FIRST_RENTAL = datetime.datetime(2005, 5, 24, 22, 0, 0)
+RENTAL_SPAN_DAYS = 270
+OPEN_RENTAL_RATIO = 0.01
+
+
+def _timestamp(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def build(path, scale=1, seed=1):
+    """Create (or replace) a fixture database at path."""
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+
+    conn.execute("INSERT INTO language (language_id, name) VALUES (1, 'English')")
+    conn.executemany(
+        "INSERT INTO category (category_id, name) VALUES (?, ?)",
+        enumerate(CATEGORIES, start=1),
+    )
+    conn.executemany(
+        "INSERT INTO store (store_id) VALUES (?)",
+        [(store_id,) for store_id in range(1, STORES + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO city (city_id, city) VALUES (?, ?)",
+        [(city_id, f"City {city_id}") for city_id in range(1, CITIES + 1)],
+    )
+
+    titles = set()
+    while len(titles) < FILMS:
+        titles.add(f"{rng.choice(WORDS)} {rng.choice(WORDS)}")
+    conn.executemany(
+        "INSERT INTO film (film_id, title, description, release_year,"
+        " language_id, rating) VALUES (?, ?, ?, 2006, 1, ?)",
+        [(film_id, title, f"A {title.title()} story",
+          rng.choice(["G", "PG", "PG-13", "R", "NC-17"]))
+         for film_id, title in enumerate(sorted(titles), start=1)],
+    )
+    conn.executemany(
+        "INSERT INTO film_category (film_id, category_id) VALUES (?, ?)",
+        [(film_id, rng.randint(1, len(CATEGORIES)))
+         for film_id in range(1, FILMS + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO actor (actor_id, first_name, last_name) VALUES (?, ?, ?)",
+        [(actor_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+         for actor_id in range(1, ACTORS + 1)],
+    )
+    film_actors = set()
+    while len(film_actors) < FILMS * FILM_ACTORS_PER_FILM:
+        film_actors.add((rng.randint(1, ACTORS), rng.randint(1, FILMS)))
+    conn.executemany(
+        "INSERT INTO film_actor (actor_id, film_id) VALUES (?, ?)",
+        sorted(film_actors),
+    )
+
+    customers = CUSTOMERS * scale
+    conn.executemany(
+        "INSERT INTO address (address_id, address, district, city_id,"
+        " postal_code, phone) VALUES (?, ?, ?, ?, ?, ?)",
+        ((address_id, f"{address_id} {rng.choice(WORDS).title()} Street",
+          "District", rng.randint(1, CITIES), f"{rng.randint(10000, 99999)}",
+          f"{rng.randint(10 ** 9, 10 ** 10 - 1)}")
+         for address_id in range(1, customers + 1)),
+    )
+    conn.executemany(
+        "INSERT INTO customer (customer_id, store_id, first_name, last_name,"
+        " email, address_id, active, create_date)"
+        " VALUES (?, ?, ?, ?, ?, ?, 1, '2006-02-14 22:04:36')",
+        ((customer_id, rng.randint(1, STORES), first, last,
+          f"{first}.{last}{customer_id}@sakilacustomer.org", customer_id)
+         for customer_id in range(1, customers + 1)
+         for first, last in [(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))]),
+    )
+
+    inventory = INVENTORY * scale
+    conn.executemany(
+        "INSERT INTO inventory (inventory_id, film_id, store_id)"
+        " VALUES (?, ?, ?)",
+        ((inventory_id, rng.randint(1, FILMS), rng.randint(1, STORES))
+         for inventory_id in range(1, inventory + 1)),
+    )
+
+    rentals = RENTALS * scale
+    span = RENTAL_SPAN_DAYS * 24 * 3600
+
+    def rental_rows():
+        for rental_id in range(1, rentals + 1):
+            rented = FIRST_RENTAL + datetime.timedelta(
+                seconds=span * rental_id // rentals
+            )
+            returned = None
+            if rng.random() > OPEN_RENTAL_RATIO:
+                returned = _timestamp(
+                    rented + datetime.timedelta(hours=rng.randint(24, 240))
+                )
+            yield (rental_id, _timestamp(rented), rng.randint(1, inventory),
+                   rng.randint(1, customers), returned, rng.randint(1, 2))
+
+    conn.executemany(
+        "INSERT INTO rental (rental_id, rental_date, inventory_id,"
+        " customer_id, return_date, staff_id) VALUES (?, ?, ?, ?, ?, ?)",
+        rental_rows(),
+    )
+    # One payment per rental, paid by the renting customer
+    conn.execute("""
+        INSERT INTO payment (customer_id, staff_id, rental_id, amount,
+                             payment_date)
+        SELECT customer_id, staff_id, rental_id,
+               0.99 + (rental_id % 5), rental_date
+        FROM rental
+    """)
+    conn.execute(
+        "INSERT INTO admin_users (username, password) VALUES ('admin', 'admin')"
+    )
+    conn.execute("INSERT INTO fixture_info VALUES (?, ?)", (scale, seed))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def ensure(path=None, scale=1, seed=1):
+    """Return the path of a fixture with this scale, building it if needed."""
+    path = path or DEFAULT_PATH.format(scale=scale)
+    if os.path.exists(path):
+        try:
+            conn = sqlite3.connect(path)
+            info = conn.execute("SELECT scale, seed FROM fixture_info").fetchone()
+            # Fixtures built before the city table was added are rebuilt
+            conn.execute("SELECT 1 FROM city LIMIT 1")
+            conn.close()
+            if info == (scale, seed):
+                return path
+        except sqlite3.Error:
+            pass
+    build(path, scale, seed)
+    return path
+
+
+def working_copy(path):
+    """
+    Copy the fixture at path to a temporary directory that is removed at
+    exit, and return the copy's path, so writes made by a run don't change
+    the data the next run measures.
+    """
+    directory = tempfile.mkdtemp(prefix="sakila-fixture-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    copy_path = os.path.join(directory, os.path.basename(path))
+    source = sqlite3.connect(path)
+    copy = sqlite3.connect(copy_path)
+    source.backup(copy)
+    copy.close()
+    source.close()
+    return copy_path
+
+
+def copy_replicas(path, count):
+    """
+    Copy the fixture at path to count files next to it for use as read
+    replicas, and return their paths. They are snapshots: writes made
+    through the app afterwards only reach the primary.
+    """
+    source = sqlite3.connect(path)
+    paths = []
+    for number in range(1, count + 1):
+        replica_path = f"{path}.replica-{number}"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(replica_path + suffix):
+                os.remove(replica_path + suffix)
+        replica = sqlite3.connect(replica_path)
+        source.backup(replica)
+        replica.close()
+        paths.append(replica_path)
+    source.close()
+    return paths
+
+
+def _now():
+    return _timestamp(datetime.datetime.now())
+
+
+def _database_uri(path):
+    # The main database is a private in-memory one per connection, named
+    # after the fixture so the connect listener knows what to attach
+    return (f"sqlite:///file:{path}.main"
+            "?mode=memory&check_same_thread=false&uri=true")
+
+
+def use_local_database(path, replica_paths=()):
+    """
+    Point the app at the fixture at path; call before importing app. Each
+    of replica_paths (copies of the fixture) is used as a read replica and
+    attached read-only, so a write routed to one fails as it would on a
+    real replica.
+    """
+    path = os.path.abspath(path)
+    replica_paths = [os.path.abspath(replica) for replica in replica_paths]
+    # The fixture is attached as the sakila schema (see below), so
+    # unqualified table names resolve to it through the attach search order.
+    os.environ["SAKILA_DATABASE_URI"] = _database_uri(path)
+    if replica_paths:
+        os.environ["SAKILA_REPLICA_URIS"] = ",".join(
+            _database_uri(replica) for replica in replica_paths
+        )
+
+    @event.listens_for(Engine, "do_connect")
+    def find_fixture(dialect, connection_record, cargs, cparams):
+        name = cargs[0] if cargs else ""
+        name = name.split("?")[0].removeprefix("file:").removesuffix(".main")
+        if name in replica_paths:
+            connection_record.info["fixture"] = f"file:{name}?mode=ro"
+
+    @event.listens_for(Engine, "connect")
+    def attach_sakila(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        # The app qualifies some tables with the sakila and film_store
+        # schemas; both are the same file here.
+        fixture = connection_record.info.get("fixture", path)
+        escaped = fixture.replace("'", "''")
+        dbapi_connection.execute(f"ATTACH DATABASE '{escaped}' AS sakila")
+        dbapi_connection.execute(f"ATTACH DATABASE '{escaped}' AS film_store")
+        dbapi_connection.execute("PRAGMA busy_timeout = 10000")
+        dbapi_connection.create_function("NOW", 0, _now)
+        dbapi_connection.create_function(
+            "LAST_INSERT_ID", 0,
+            lambda: dbapi_connection.execute(
+                "SELECT last_insert_rowid()"
+            ).fetchone()[0],
+        )
+        dbapi_connection.create_function("ST_GeomFromText", 1, lambda wkt: wkt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    path = args.path or DEFAULT_PATH.format(scale=args.scale)
+    started = time.perf_counter()
+    build(path, args.scale, args.seed)
+    print(f"built {path} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Load test for every blueprint route against a local Sakila fixture.
+
+Builds (or reuses) a SQLite fixture at the requested scale, points the app
+at a fresh copy of it, so the writes in the mix don't carry over into the
+next run, and drives each route in-process from a pool of client threads.
+Prints, or writes with --output, a JSON document with throughput and
+p50/p95/p99 latency per route that can be diffed between commits.
+
+    python bench/load.py --scale 10 --concurrency 16 --requests 1000
+    python bench/load.py --routes landing search_films --output before.json
+    python bench/load.py --replicas 1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fixture  # noqa: E402
+
+READY_TIMEOUT_SECONDS = 60
+
+
+def scenarios(scale):
+    """Route name -> function(rng, state) returning (method, path, body)."""
+    customers = fixture.CUSTOMERS * scale
+
+    def customer_id(rng):
+        return rng.randint(1, customers)
+
+    def search(rng):
+        term = rng.choice(fixture.WORDS)[:rng.randint(3, 6)].lower()
+        field = rng.choice(["film", "actor", "genre"])
+        if field == "actor":
+            term = rng.choice(fixture.LAST_NAMES)[:4].lower()
+        elif field == "genre":
+            term = rng.choice(fixture.CATEGORIES)[:3].lower()
+        return "GET", f"/films?{field}={term}", None
+
+    def lookup(rng):
+        # What has been typed after a few keystrokes: a name prefix,
+        # sometimes followed by the start of the other name
+        term = rng.choice(fixture.FIRST_NAMES)[:rng.randint(1, 5)].lower()
+        if rng.random() < 0.3:
+            term += "+" + rng.choice(fixture.LAST_NAMES)[:rng.randint(1, 3)].lower()
+        return "GET", f"/api/customers/lookup?q={term}", None
+
+    def return_rental(rng, state):
+        with state["lock"]:
+            open_rentals = state["open_rentals"]
+            rental_id = open_rentals.pop() if open_rentals else 0
+        return "PUT", f"/api/customers/return_rental/{rental_id}", None
+
+    def customer_body(rng):
+        return {
+            "first_name": rng.choice(fixture.FIRST_NAMES),
+            "last_name": rng.choice(fixture.LAST_NAMES),
+            "email": "load@sakilacustomer.org",
+            "store_id": rng.randint(1, fixture.STORES),
+            "address": f"{rng.randint(1, 999)} Load Street",
+            "district": "District",
+            "city_id": rng.randint(1, 600),
+            "postal_code": "12345",
+            "phone": "5555555555",
+        }
+
+    return {
+        "landing": lambda rng, state: ("GET", "/", None),
+        "film_details": lambda rng, state: (
+            "GET", f"/film/{rng.randint(1, fixture.FILMS)}", None),
+        "actor_details": lambda rng, state: (
+            "GET", f"/actor/{rng.randint(1, fixture.ACTORS)}", None),
+        "search_films": lambda rng, state: search(rng),
+        "customers_page": lambda rng, state: (
+            "GET", f"/api/customers/?page={rng.randint(1, 100)}", None),
+        "customers_cursor": lambda rng, state: (
+            "GET", "/api/customers/?cursor=&per_page=25", None),
+        "customer_lookup": lambda rng, state: lookup(rng),
+        "customer_details": lambda rng, state: (
+            "GET", f"/api/customers/{customer_id(rng)}", None),
+        "customer_rentals": lambda rng, state: (
+            "GET", f"/api/customers/{customer_id(rng)}/rentals", None),
+        "rent_film": lambda rng, state: (
+            "POST", "/rentals/rent",
+            {"customer_id": customer_id(rng),
+             "film_id": rng.randint(1, fixture.FILMS)}),
+        "return_rental": return_rental,
+        "add_customer": lambda rng, state: (
+            "POST", "/api/customers/", customer_body(rng)),
+        "update_customer": lambda rng, state: (
+            "PUT", f"/api/customers/{customer_id(rng)}", customer_body(rng)),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 3)
+
+
+def run_route(app, make_request, state, requests, concurrency, seed):
+    """Send requests from concurrency threads; return latency stats."""
+    lock = threading.Lock()
+    remaining = [requests]
+    latencies = []
+    statuses = {}
+
+    def worker(worker_id):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + worker_id)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            method, path, body = make_request(rng, state)
+            started = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            elapsed = time.perf_counter() - started
+            response.close()
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = (
+                    statuses.get(response.status_code, 0) + 1
+                )
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(n for code, n in statuses.items() if code >= 500),
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": percentile(latencies, 1.0),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR, stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_until_ready():
+    """Wait for the worker's warm-up so the run measures the warm path."""
+    import startup
+
+    deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+    while not startup.state.ready:
+        if time.monotonic() > deadline:
+            raise RuntimeError("app did not become ready")
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=int, default=1,
+                        help="multiple of stock Sakila row counts")
+    parser.add_argument("--fixture", help="fixture path (built if missing)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per route")
+    parser.add_argument("--warmup", type=int, default=20,
+                        help="unmeasured requests per route")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--routes", nargs="+", help="only run these routes")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="read replicas (copies of the fixture) to use")
+    args = parser.parse_args()
+
+    path = fixture.working_copy(
+        fixture.ensure(args.fixture, args.scale, args.seed)
+    )
+    replicas = fixture.copy_replicas(path, args.replicas)
+    fixture.use_local_database(path, replicas)
+
+    from sqlalchemy import text
+
+    from extensions import db
+    from wsgi import app
+
+    wait_until_ready()
+    with app.app_context():
+        open_rentals = [row[0] for row in db.session.execute(text(
+            "SELECT rental_id FROM rental WHERE return_date IS NULL"
+        ))]
+    state = {"lock": threading.Lock(), "open_rentals": open_rentals}
+
+    all_routes = scenarios(args.scale)
+    routes = args.routes or list(all_routes)
+    unknown = set(routes) - set(all_routes)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in routes:
+        if args.warmup:
+            run_route(app, all_routes[name], state, args.warmup,
+                      args.concurrency, args.seed + 1)
+        results[name] = run_route(app, all_routes[name], state, args.requests,
+                                  args.concurrency, args.seed)
+        print(f"{name}: {results[name]['throughput_rps']} req/s, "
+              f"p95 {results[name]['p95_ms']} ms", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "scale": args.scale,
+            "seed": args.seed,
+            "concurrency": args.concurrency,
+            "replicas": args.replicas,
+            "requests_per_route": args.requests,
+            "python": platform.python_version(),
+            "database": "sqlite fixture",
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
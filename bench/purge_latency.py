@@ -0,0 +1,175 @@
+"""
+Customer purge benchmark: rental latency while a big customer is deleted.
+
+Gives a customer a long rental and payment history, deletes them through
+DELETE /api/customers/<id> and runs the purge while client threads keep
+renting films through /rentals/rent. Runs once with a chunk size large
+enough to purge each table in a single transaction (the old in-request
+behaviour) and once with --chunk-rows, and prints per mode the rent
+latency percentiles during the purge, the purge duration and the longest
+chunk transaction (lock hold time) as JSON lines. Rentals it creates are
+deleted afterwards.
+
+    python bench/purge_latency.py --local --history 20000 --chunk-rows 500
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture  # noqa: E402
+
+# Must run before app is imported
+if "--local" in sys.argv:
+    fixture.use_local_database(fixture.ensure())
+# The benchmark runs the purge itself; seeding would flood the slow log
+os.environ["CUSTOMER_PURGE_WORKER_ENABLED"] = "0"
+os.environ.setdefault("SLOW_QUERY_MS", "60000")
+
+from sqlalchemy import text  # noqa: E402
+
+from extensions import db  # noqa: E402
+from wsgi import app  # noqa: E402
+from purge import purger  # noqa: E402
+
+CREATE_CUSTOMER = text("""
+    INSERT INTO sakila.customer
+        (store_id, first_name, last_name, email, address_id, active, create_date)
+    SELECT store_id, 'PURGE', 'BENCH', email, address_id, 1, create_date
+    FROM sakila.customer WHERE customer_id = 1
+""")
+
+ADD_RENTAL = text("""
+    INSERT INTO sakila.rental
+        (rental_date, inventory_id, customer_id, return_date, staff_id)
+    VALUES (:rental_date, :inventory_id, :customer_id, :rental_date, 1)
+""")
+
+ADD_PAYMENTS = text("""
+    INSERT INTO sakila.payment
+        (customer_id, staff_id, rental_id, amount, payment_date)
+    SELECT customer_id, 1, rental_id, 2.99, rental_date
+    FROM sakila.rental WHERE customer_id = :customer_id
+""")
+
+
+def seed_customer(history):
+    """Create a customer with history returned rentals and payments."""
+    with app.app_context():
+        db.session.execute(CREATE_CUSTOMER)
+        customer_id = db.session.execute(text(
+            "SELECT MAX(customer_id) FROM sakila.customer"
+        )).scalar()
+        inventory = db.session.execute(text(
+            "SELECT inventory_id FROM sakila.inventory"
+        )).scalars().all()
+        db.session.execute(ADD_RENTAL, [
+            {"rental_date": f"2005-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}",
+             "inventory_id": random.choice(inventory),
+             "customer_id": customer_id}
+            for i in range(history)
+        ])
+        db.session.execute(ADD_PAYMENTS, {"customer_id": customer_id})
+        db.session.commit()
+        return customer_id
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_mode(name, chunk_rows, history, threads, films):
+    customer_id = seed_customer(history)
+    with app.app_context():
+        start_id = db.session.execute(
+            text("SELECT MAX(rental_id) FROM sakila.rental")
+        ).scalar()
+
+    client = app.test_client()
+    response = client.delete(f"/api/customers/{customer_id}")
+    job_id = response.get_json()["job_id"]
+
+    done = threading.Event()
+    timings = []
+    timings_lock = threading.Lock()
+
+    def rent():
+        client = app.test_client()
+        while not done.is_set():
+            started = time.perf_counter()
+            client.post("/rentals/rent", json={
+                "customer_id": 1, "film_id": random.choice(films),
+            })
+            elapsed = time.perf_counter() - started
+            with timings_lock:
+                timings.append(elapsed)
+
+    renters = [threading.Thread(target=rent) for _ in range(threads)]
+    for thread in renters:
+        thread.start()
+    time.sleep(0.2)
+
+    purger.chunk_rows = chunk_rows
+    started = time.perf_counter()
+    with app.app_context():
+        purger.run_pending(db.session)
+        purge_seconds = time.perf_counter() - started
+        job = purger.job(db.session, job_id)
+    done.set()
+    for thread in renters:
+        thread.join()
+
+    with app.app_context():
+        db.session.execute(
+            text("DELETE FROM sakila.rental WHERE rental_id > :start_id"),
+            {"start_id": start_id},
+        )
+        db.session.commit()
+
+    timings.sort()
+    return {
+        "mode": name,
+        "chunk_rows": chunk_rows,
+        "status": job["status"],
+        "rows_deleted": job["payments_deleted"] + job["rentals_deleted"],
+        "chunks": job["chunks"],
+        "max_chunk_ms": job["max_chunk_ms"],
+        "purge_seconds": round(purge_seconds, 3),
+        "rents": len(timings),
+        "rent_p50_ms": round(percentile(timings, 0.5) * 1000, 2),
+        "rent_p95_ms": round(percentile(timings, 0.95) * 1000, 2),
+        "rent_p99_ms": round(percentile(timings, 0.99) * 1000, 2),
+        "rent_max_ms": round(timings[-1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--history", type=int, default=20000,
+                        help="rentals (and payments) of the purged customer")
+    parser.add_argument("--chunk-rows", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--local", action="store_true",
+                        help="run against the scale 1 SQLite fixture")
+    args = parser.parse_args()
+
+    with app.app_context():
+        purger.create_table(db.session)
+        films = db.session.execute(
+            text("SELECT film_id FROM film")
+        ).scalars().all()
+
+    modes = [("single", args.history * 2), ("chunked", args.chunk_rows)]
+    for name, chunk_rows in modes:
+        result = run_mode(name, chunk_rows, args.history, args.threads,
+                          films)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
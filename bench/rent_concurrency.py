@@ -0,0 +1,179 @@
+"""
+Concurrent rental benchmark.
+
+Fires rent requests from many threads at a handful of popular films and
+reports rentals/sec plus the number of inventory copies that ended up with
+more than one open rental. Runs the pre-allocator anti-join logic ("legacy")
+and the allocator used by /rentals/rent ("allocator") against the scale 1
+SQLite fixture, or with --configured-database against the app's configured
+database, and deletes the rentals it created afterwards. Both modes skip
+the HTTP layer so only the allocation strategy differs.
+
+    python bench/rent_concurrency.py --threads 16 --requests 400
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture  # noqa: E402
+
+# Must run before app is imported
+if "--configured-database" not in sys.argv:
+    fixture.use_local_database(fixture.ensure())
+
+from sqlalchemy import bindparam, text  # noqa: E402
+
+from extensions import db  # noqa: E402
+from wsgi import app  # noqa: E402
+from availability import allocator  # noqa: E402
+
+LEGACY_AVAILABILITY = text("""
+    SELECT i.inventory_id FROM inventory i
+    LEFT JOIN rental r ON i.inventory_id = r.inventory_id AND r.return_date IS NULL
+    WHERE i.film_id = :film_id AND r.inventory_id IS NULL
+    LIMIT 1
+""")
+
+RENT = text("""
+    INSERT INTO rental (rental_date, inventory_id, customer_id, return_date, staff_id)
+    VALUES (NOW(), :inventory_id, :customer_id, NULL, 1)
+""")
+
+DELETE_RENTALS = text(
+    "DELETE FROM rental WHERE rental_id IN :rental_ids"
+).bindparams(bindparam("rental_ids", expanding=True))
+DELETE_CHUNK = 500
+
+DOUBLE_ALLOCATIONS = text("""
+    SELECT COUNT(*) FROM (
+        SELECT inventory_id FROM rental
+        WHERE return_date IS NULL
+        GROUP BY inventory_id
+        HAVING COUNT(*) > 1
+    ) AS doubled
+""")
+
+
+def legacy_rent(customer_id, film_id):
+    """
+    The rent_film logic from before the allocator, minus Flask. Returns the
+    new rental_id, or None.
+    """
+    with app.app_context():
+        try:
+            row = db.session.execute(
+                LEGACY_AVAILABILITY, {"film_id": film_id}
+            ).fetchone()
+            if not row:
+                return False
+            result = db.session.execute(
+                RENT, {"inventory_id": row[0], "customer_id": customer_id}
+            )
+            db.session.commit()
+            return result.lastrowid
+        except Exception:
+            db.session.rollback()
+            return None
+
+
+def allocator_rent(customer_id, film_id):
+    """The current rent_film logic, minus Flask; see legacy_rent()."""
+    with app.app_context():
+        inventory_id = None
+        try:
+            inventory_id = allocator.allocate(db.session, film_id)
+            if not inventory_id:
+                db.session.rollback()
+                return None
+            params = {"inventory_id": inventory_id, "customer_id": customer_id}
+            result = db.session.execute(RENT, params)
+            db.session.commit()
+            allocator.confirm(inventory_id)
+            return result.lastrowid
+        except Exception:
+            db.session.rollback()
+            if inventory_id:
+                allocator.release(film_id, inventory_id)
+            return None
+
+
+def run(mode, films, threads, requests):
+    with app.app_context():
+        doubled_before = db.session.execute(DOUBLE_ALLOCATIONS).scalar()
+
+    rng = random.Random(42)
+    work = [(rng.randint(1, 500), rng.choice(films)) for _ in range(requests)]
+    lock = threading.Lock()
+    counts = {"ok": 0, "rejected": 0}
+    created = []
+
+    def worker():
+        while True:
+            with lock:
+                if not work:
+                    return
+                customer_id, film_id = work.pop()
+            if mode == "legacy":
+                rental_id = legacy_rent(customer_id, film_id)
+            else:
+                rental_id = allocator_rent(customer_id, film_id)
+            with lock:
+                counts["ok" if rental_id else "rejected"] += 1
+                if rental_id:
+                    created.append(rental_id)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        doubled = db.session.execute(DOUBLE_ALLOCATIONS).scalar()
+        # Only this run's rentals; other clients may be renting too
+        for start in range(0, len(created), DELETE_CHUNK):
+            db.session.execute(DELETE_RENTALS, {
+                "rental_ids": created[start:start + DELETE_CHUNK]
+            })
+        db.session.commit()
+
+    return {
+        "mode": mode,
+        "threads": threads,
+        "requests": requests,
+        "rented": counts["ok"],
+        "rejected": counts["rejected"],
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(requests / elapsed, 1),
+        "double_allocations": doubled - doubled_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--films", type=int, nargs="+",
+                        default=[1, 2, 3, 4, 5, 6, 7, 8])
+    parser.add_argument("--mode", choices=["legacy", "allocator", "both"],
+                        default="both")
+    parser.add_argument("--configured-database", action="store_true",
+                        help="run against SAKILA_DATABASE_URI instead of the "
+                             "scale 1 SQLite fixture")
+    args = parser.parse_args()
+
+    modes = ["legacy", "allocator"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        print(json.dumps(run(mode, args.films, args.threads, args.requests)))
+
+
+if __name__ == "__main__":
+    main()
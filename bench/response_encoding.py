@@ -0,0 +1,127 @@
+"""
+Response encoding benchmark: JSON encoder, columnar format and compression.
+
+Requests each list endpoint with the stdlib and the fast JSON provider, in
+row and columnar format, and with no, gzip and brotli content encoding. For
+every combination prints the CPU time per request (process time, so the
+in-process SQLite queries are included and the differences are what the
+encoding adds) and the payload size, as JSON lines. A final set of lines
+times serialization alone on a page of rental rows.
+
+    python bench/response_encoding.py --local --iterations 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixture  # noqa: E402
+
+# Must run before app is imported
+if "--local" in sys.argv:
+    fixture.use_local_database(fixture.ensure())
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+from extensions import db  # noqa: E402
+from wsgi import app  # noqa: E402
+import customers  # noqa: E402
+import encoding  # noqa: E402
+
+ENDPOINTS = [
+    "/",
+    "/films?film=a&per_page=100",
+    "/api/customers/?per_page=100",
+    "/api/customers/1",
+    "/api/customers/1/rentals?per_page=500",
+]
+
+ENCODINGS = ["identity", "gzip"] + (["br"] if encoding.brotli else [])
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """Flask's own encoder, taught to serialize result rows."""
+
+    default = staticmethod(encoding._default)
+
+
+def measure(client, path, accept_encoding, iterations):
+    headers = {"Accept-Encoding": accept_encoding}
+    client.get(path, headers=headers)
+    started = time.process_time()
+    for _ in range(iterations):
+        response = client.get(path, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: {response.status_code}")
+    cpu = time.process_time() - started
+    return {
+        "cpu_ms_per_request": round(cpu / iterations * 1000, 3),
+        "bytes": len(response.get_data()),
+    }
+
+
+def measure_encoder(provider, rows, columnar, iterations):
+    query = "?format=columnar" if columnar else ""
+    with app.test_request_context("/" + query):
+        started = time.process_time()
+        for _ in range(iterations):
+            body = provider.response({"rentals": encoding.table(
+                rows, customers.RENTAL_COLUMNS
+            )}).get_data()
+        cpu = time.process_time() - started
+    return {
+        "cpu_ms_per_page": round(cpu / iterations * 1000, 3),
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--local", action="store_true",
+                        help="run against the scale 1 SQLite fixture")
+    args = parser.parse_args()
+
+    providers = {"stdlib": StdlibJSONProvider(app)}
+    if encoding.orjson is not None:
+        providers["fast"] = encoding.FastJSONProvider(app)
+
+    client = app.test_client()
+    for path in ENDPOINTS:
+        for provider_name, provider in providers.items():
+            app.json = provider
+            for fmt in ("rows", "columnar"):
+                url = path
+                if fmt == "columnar":
+                    url += ("&" if "?" in path else "?") + "format=columnar"
+                for accept_encoding in ENCODINGS:
+                    result = measure(client, url, accept_encoding,
+                                     args.iterations)
+                    result.update(path=path, encoder=provider_name,
+                                  format=fmt, encoding=accept_encoding)
+                    print(json.dumps(result))
+
+    with app.app_context():
+        rows = db.session.execute(text("""
+            SELECT r.rental_id, f.film_id, f.title, r.rental_date, r.return_date
+            FROM sakila.rental r
+            JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+            JOIN sakila.film f ON i.film_id = f.film_id
+            ORDER BY r.rental_date DESC, r.rental_id DESC
+            LIMIT 500
+        """)).mappings().all()
+    for provider_name, provider in providers.items():
+        for columnar in (False, True):
+            result = measure_encoder(provider, rows, columnar,
+                                     args.iterations)
+            result.update(encoder=provider_name, rows=len(rows),
+                          format="columnar" if columnar else "rows")
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import csv
+import json
+import time
+
+from queries import MultiRowInsert, Statement
+
+DEFAULT_CHUNK_ROWS = 1000
+DEFAULT_MAX_ERRORS = 1000
+
+REQUIRED = ["first_name", "last_name", "store_id", "address", "district",
+            "city_id", "postal_code", "phone"]
+FIELDS = REQUIRED + ["email", "address2"]
+# Column widths in the Sakila schema
+MAX_LENGTHS = {
+    "first_name": 45, "last_name": 45, "email": 50, "address": 50,
+    "address2": 50, "district": 20, "postal_code": 10, "phone": 20,
+}
+
+INSERT_ADDRESSES = MultiRowInsert(
+    "customer_import.addresses",
+    """
+    INSERT INTO sakila.address
+        (address, address2, district, city_id, postal_code, phone, location)
+    VALUES {rows}
+    """,
+    "(:address, :address2, :district, :city_id, :postal_code, :phone,"
+    " ST_GeomFromText('POINT(0 0)'))",
+)
+
+# Addresses inserted where the ids of one INSERT aren't evenly spaced carry
+# this last_update until their ids have been read back. Only the inserting
+# transaction sees them before it is reset, so it tells them apart from the
+# rows other transactions insert meanwhile.
+PENDING_MARK = "1970-01-02"
+
+INSERT_MARKED_ADDRESSES = MultiRowInsert(
+    "customer_import.marked_addresses",
+    """
+    INSERT INTO sakila.address
+        (address, address2, district, city_id, postal_code, phone, location,
+         last_update)
+    VALUES {rows}
+    """,
+    "(:address, :address2, :district, :city_id, :postal_code, :phone,"
+    f" ST_GeomFromText('POINT(0 0)'), '{PENDING_MARK}')",
+)
+
+MARKED_ADDRESS_IDS = Statement("customer_import.marked_address_ids", """
+    SELECT address_id FROM sakila.address
+    WHERE address_id >= :first_id AND last_update = :mark
+    ORDER BY address_id
+""")
+
+UNMARK_ADDRESSES = Statement("customer_import.unmark_addresses", """
+    UPDATE sakila.address SET last_update = CURRENT_TIMESTAMP
+    WHERE address_id >= :first_id AND last_update = :mark
+""")
+
+INSERT_CUSTOMERS = MultiRowInsert(
+    "customer_import.customers",
+    """
+    INSERT INTO sakila.customer
+        (store_id, first_name, last_name, email, address_id, active,
+         create_date)
+    VALUES {rows}
+    """,
+    "(:store_id, :first_name, :last_name, :email, :address_id, 1, NOW())",
+)
+
+STORE_IDS_QUERY = Statement("customer_import.store_ids",
+                            "SELECT store_id FROM sakila.store")
+CITY_IDS_QUERY = Statement("customer_import.city_ids",
+                           "SELECT city_id FROM sakila.city")
+AUTO_INCREMENT_QUERY = Statement(
+    "customer_import.auto_increment",
+    "SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode",
+)
+
+
+INVALID_UTF8 = "Not valid UTF-8"
+
+
+def _decode_lines(stream, first_encoding, bad_lines):
+    """
+    Decode each line of a byte stream. Lines that aren't valid UTF-8 are
+    decoded with replacement characters and their numbers appended to
+    bad_lines.
+    """
+    encoding = first_encoding
+    for number, line in enumerate(stream, 1):
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError:
+            bad_lines.append(number)
+            yield line.decode("utf-8", "replace")
+        encoding = "utf-8"
+
+
+def read_csv(stream):
+    """(row number, record) for each row of a CSV byte stream with a header."""
+    bad_lines = []
+    reader = csv.DictReader(_decode_lines(stream, "utf-8-sig", bad_lines))
+    if reader.fieldnames is None:
+        return
+    if bad_lines:
+        yield 0, f"{INVALID_UTF8} in the header"
+        return
+    read = reader.line_num
+    for number, record in enumerate(reader, 1):
+        # A record can span lines (quoted newlines)
+        if bad_lines and bad_lines[-1] > read:
+            record = INVALID_UTF8
+        read = reader.line_num
+        yield number, record
+
+
+def read_ndjson(stream):
+    """(row number, record) for each non-blank line of an NDJSON stream."""
+    for number, line in enumerate(stream, 1):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError:
+            yield number, INVALID_UTF8
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield number, "Expected a JSON object"
+            continue
+        yield number, record
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def validate(record, store_ids, city_ids):
+    """The insert parameters for record, or raise ValueError."""
+    values = {}
+    for field in FIELDS:
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip() or None
+        elif value is not None:
+            value = str(value)
+        values[field] = value
+
+    missing = [field for field in REQUIRED if values[field] is None]
+    if missing:
+        raise ValueError("Missing required fields: " + ", ".join(missing))
+    for field, length in MAX_LENGTHS.items():
+        value = values[field]
+        if value is not None and len(value) > length:
+            raise ValueError(f"{field} is longer than {length} characters")
+    for field, known in (("store_id", store_ids), ("city_id", city_ids)):
+        try:
+            values[field] = int(values[field])
+        except ValueError:
+            raise ValueError(f"{field} must be an integer")
+        if values[field] not in known:
+            raise ValueError(f"Unknown {field} {values[field]}")
+    return values
+
+
+def id_step(session):
+    """
+    The step between the ids of the rows of one multi-row INSERT, or None
+    where they aren't evenly spaced. SQLite holds the write lock, so they
+    are consecutive. InnoDB reserves them all at once for an INSERT ...
+    VALUES in auto-increment lock modes 0 and 1, auto_increment_increment
+    apart; in mode 2 (the MySQL 8 default) concurrent inserts can take ids
+    in between.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return 1
+    if dialect != "mysql":
+        return None
+    increment, lock_mode = AUTO_INCREMENT_QUERY.execute(session).one()
+    return int(increment) if int(lock_mode) < 2 else None
+
+
+def first_id(session, result, count, step):
+    """
+    The id generated for the first row of a multi-row INSERT. MySQL
+    reports it as lastrowid, SQLite the last one.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        return result.lastrowid - (count - 1) * step
+    return result.lastrowid
+
+
+def insert_addresses(session, rows, step):
+    """Insert the addresses of rows and set each row's address_id."""
+    if step is None:
+        insert_marked_addresses(session, rows)
+        return
+    result = INSERT_ADDRESSES.execute(session, rows)
+    address_id = first_id(session, result, len(rows), step)
+    for offset, values in enumerate(rows):
+        values["address_id"] = address_id + offset * step
+
+
+def insert_marked_addresses(session, rows):
+    """
+    insert_addresses() where other transactions' rows can take ids between
+    those of one INSERT. The ids are read back in one query instead: the
+    rows are inserted with PENDING_MARK as last_update, and each INSERT
+    numbers its rows in order.
+    """
+    result = INSERT_MARKED_ADDRESSES.execute(session, rows)
+    params = {"first_id": first_id(session, result, len(rows), 1),
+              "mark": PENDING_MARK}
+    address_ids = MARKED_ADDRESS_IDS.execute(session, params).scalars().all()
+    if len(address_ids) != len(rows):
+        raise RuntimeError(f"Read back {len(address_ids)} address ids for "
+                           f"{len(rows)} addresses")
+    UNMARK_ADDRESSES.execute(session, params)
+    for values, address_id in zip(rows, address_ids):
+        values["address_id"] = address_id
+
+
+class ImportReport:
+    """Running totals of an import and the rows that failed."""
+
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": number, "error": message})
+
+    def as_dict(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "failed": self.failed,
+            "chunks": self.chunks,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds) if seconds else None,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def insert_chunk(session, chunk, report, step):
+    """Insert a chunk of (row number, values) in one transaction."""
+    rows = [values for _, values in chunk]
+    try:
+        insert_addresses(session, rows, step)
+        INSERT_CUSTOMERS.execute(session, rows)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        for number, _ in chunk:
+            report.error(number, f"Chunk not imported: {e}")
+        return
+    report.imported += len(rows)
+    report.chunks += 1
+
+
+def import_customers(session, records, chunk_rows=DEFAULT_CHUNK_ROWS,
+                     max_errors=DEFAULT_MAX_ERRORS):
+    """
+    Validate and insert (row number, record) pairs as they are read.
+    Records are mappings with the add_customer fields, or a message for
+    rows that couldn't be parsed. Valid rows are written chunk_rows at a
+    time: one multi-row INSERT for their addresses (followed by a query
+    for their ids and one to reset their mark where the ids of a multi-row
+    INSERT aren't evenly spaced, see id_step) and one for the customers,
+    then a commit. Returns the report as a dict; rows that failed
+    validation, or whose chunk failed, are listed (up to max_errors) with
+    the reason.
+    """
+    store_ids = set(STORE_IDS_QUERY.execute(session).scalars())
+    city_ids = set(CITY_IDS_QUERY.execute(session).scalars())
+    step = id_step(session)
+    session.commit()
+
+    report = ImportReport(max_errors)
+    chunk = []
+    for number, record in records:
+        report.rows += 1
+        if isinstance(record, str):
+            report.error(number, record)
+            continue
+        try:
+            chunk.append((number, validate(record, store_ids, city_ids)))
+        except ValueError as e:
+            report.error(number, str(e))
+            continue
+        if len(chunk) >= chunk_rows:
+            insert_chunk(session, chunk, report, step)
+            chunk = []
+    if chunk:
+        insert_chunk(session, chunk, report, step)
+    return report.as_dict()
@@ -0,0 +1,282 @@
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from operator import itemgetter
+
+from background import run_periodically
+from film_search import EPOCH, TrigramIndex
+from queries import Statement
+
+DEFAULT_REFRESH_SECONDS = 30
+DEFAULT_LIMIT = 10
+COLUMNS = ["customer_id", "first_name", "last_name", "email", "store_id"]
+
+# Match ranks: a whole word, the start of a word, anywhere in a word
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+
+CUSTOMERS_QUERY = Statement("customer_search.customers", """
+    SELECT customer_id, first_name, last_name, email, store_id, active
+    FROM sakila.customer
+    WHERE last_update >= :since
+""")
+
+WATERMARK_QUERY = Statement(
+    "customer_search.watermark",
+    "SELECT COUNT(*), MAX(last_update) FROM sakila.customer",
+)
+
+
+def _after(prefix):
+    """The first string after every string that starts with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _names(customer):
+    """A customer's names, lowercased."""
+    return {customer["first_name"].lower(), customer["last_name"].lower()}
+
+
+class CustomerSearchIndex:
+    """In-memory typeahead index over active customers' names and emails.
+
+    Many customers share a name, so names are indexed once each: a sorted
+    list of distinct names answers prefixes by binary search, a trigram
+    index over them answers substrings of three or more characters, and
+    each name maps to the sorted ids of its customers. Emails are unique,
+    so they are kept as a sorted list of (email, customer_id) pairs and
+    only matched by prefix. The index is loaded in the background, updated
+    in place by the customer write handlers of this worker and refreshed
+    periodically to pick up changes made through other workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.customers = {}
+        self.sort_keys = {}
+        self.names = []
+        self.name_ids = {}
+        self.emails = []
+        self.substrings = TrigramIndex()
+        self.ready = False
+        self._watermark = None
+        self._since = EPOCH
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.max_search_seconds = 0.0
+
+    def _add(self, customer):
+        self._remove(customer["customer_id"])
+        customer = {column: customer[column] for column in COLUMNS}
+        customer_id = customer["customer_id"]
+        self.customers[customer_id] = customer
+        self.sort_keys[customer_id] = (
+            customer["last_name"], customer["first_name"], customer_id
+        )
+        for name in _names(customer):
+            ids = self.name_ids.get(name)
+            if ids is None:
+                ids = self.name_ids[name] = []
+                bisect.insort(self.names, name)
+                self.substrings.add(name, name)
+            bisect.insort(ids, customer_id)
+        if customer["email"]:
+            email = customer["email"].lower()
+            bisect.insort(self.emails, (email, customer_id))
+
+    def _remove(self, customer_id):
+        customer = self.customers.pop(customer_id, None)
+        if customer is None:
+            return
+        del self.sort_keys[customer_id]
+        for name in _names(customer):
+            ids = self.name_ids[name]
+            del ids[bisect.bisect_left(ids, customer_id)]
+            if not ids:
+                del self.name_ids[name]
+                del self.names[bisect.bisect_left(self.names, name)]
+                self.substrings.remove(name)
+        if customer["email"]:
+            entry = (customer["email"].lower(), customer_id)
+            del self.emails[bisect.bisect_left(self.emails, entry)]
+
+    def add(self, customer):
+        """Index a new customer (a mapping with the COLUMNS keys)."""
+        with self._lock:
+            self._add(customer)
+
+    def update(self, customer):
+        """Re-index a customer whose name or email changed."""
+        with self._lock:
+            if customer["customer_id"] in self.customers:
+                self._add(customer)
+
+    def remove(self, customer_id):
+        """Drop a deleted or deactivated customer."""
+        with self._lock:
+            self._remove(customer_id)
+
+    def refresh(self, session):
+        """Bring the index up to date with sakila.customer.
+
+        Only customers whose last_update moved are re-read; a shrinking
+        table (purged customers) triggers a full rebuild.
+        """
+        count, newest = WATERMARK_QUERY.execute(session).one()
+        if (count, newest) == self._watermark:
+            return
+        since = self._since
+        if self._watermark is None or count < self._watermark[0]:
+            since = EPOCH
+        rows = CUSTOMERS_QUERY.execute(
+            session, {"since": since}
+        ).mappings().all()
+
+        with self._lock:
+            if since == EPOCH:
+                self.customers = {}
+                self.sort_keys = {}
+                self.names = []
+                self.name_ids = {}
+                self.emails = []
+                self.substrings = TrigramIndex()
+            for row in rows:
+                if row["active"]:
+                    self._add(row)
+                else:
+                    self._remove(row["customer_id"])
+            self._watermark = (count, newest)
+            # Re-read rows touched in the same second as the watermark next
+            # time rather than risk missing them.
+            self._since = str(newest) if newest is not None else EPOCH
+            self.ready = True
+
+    def _prefixed_names(self, term):
+        """Names starting with term, in order."""
+        return self.names[bisect.bisect_left(self.names, term):
+                          bisect.bisect_left(self.names, _after(term))]
+
+    def _prefixed_emails(self, term):
+        """(email, customer_id) pairs whose email starts with term."""
+        return self.emails[bisect.bisect_left(self.emails, (term,)):
+                           bisect.bisect_left(self.emails, (_after(term),))]
+
+    def _substring_names(self, term):
+        """Names containing term (three characters or more), in order."""
+        if len(term) < 3:
+            return
+        yield from sorted(self.substrings.search(term))
+
+    def _first(self, term, limit):
+        """
+        The first limit customers matching a single term. Candidates are
+        visited best match first (the name itself, names it starts, emails
+        it starts, names containing it) and alphabetically within each, so
+        this stops after limit customers however common the term is.
+        """
+        ids = []
+        seen = set()
+        name_ids = map(self.name_ids.__getitem__,
+                       self._prefixed_names(term))
+        email_ids = ([customer_id]
+                     for _, customer_id in self._prefixed_emails(term))
+        substring_ids = map(self.name_ids.__getitem__,
+                            self._substring_names(term))
+        for group in itertools.chain(name_ids, email_ids, substring_ids):
+            for customer_id in group:
+                if customer_id not in seen:
+                    seen.add(customer_id)
+                    ids.append(customer_id)
+                    if len(ids) >= limit:
+                        return ids
+        return ids
+
+    def _matches(self, term):
+        """
+        Customers matching term as a whole name or email, at the start of
+        one, and anywhere (each set contains the one before).
+        """
+        exact = set(self.name_ids.get(term, ()))
+        emails = self._prefixed_emails(term)
+        if emails and emails[0][0] == term:
+            exact.add(emails[0][1])
+        prefix = set(map(itemgetter(1), emails)).union(
+            *map(self.name_ids.__getitem__, self._prefixed_names(term))
+        )
+        anywhere = prefix.union(
+            *map(self.name_ids.__getitem__, self._substring_names(term))
+        )
+        return exact, prefix, anywhere
+
+    def _best(self, terms, limit):
+        """The best limit customers matching every term."""
+        matches = [self._matches(term) for term in terms]
+        candidates = set.intersection(*(matched for _, _, matched in matches))
+        # PREFIX for every term matched only by prefix, SUBSTRING for every
+        # term matched only inside a word
+        ranks = dict.fromkeys(candidates, EXACT)
+        for exact, prefix, _ in matches:
+            for customer_id in candidates.difference(exact):
+                ranks[customer_id] += PREFIX
+            for customer_id in candidates.difference(prefix):
+                ranks[customer_id] += SUBSTRING - PREFIX
+        sort_keys = self.sort_keys
+        return heapq.nsmallest(limit, candidates, key=lambda customer_id: (
+            ranks[customer_id], sort_keys[customer_id]
+        ))
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """
+        The best matches for what has been typed so far, as customer dicts.
+        Every word of query has to match the start of a name or the email,
+        or from three characters any part of a name. Whole words rank
+        before prefixes and prefixes before other substrings.
+        """
+        started = time.perf_counter()
+        terms = query.lower().split()
+        with self._lock:
+            if len(terms) == 1:
+                ids = self._first(terms[0], limit)
+            elif terms:
+                ids = self._best(terms, limit)
+            else:
+                ids = []
+            results = [dict(self.customers[customer_id])
+                       for customer_id in ids]
+
+            elapsed = time.perf_counter() - started
+            self.searches += 1
+            self.search_seconds += elapsed
+            self.max_search_seconds = max(self.max_search_seconds, elapsed)
+        return results
+
+    def stats(self):
+        """Return index size and search latency for monitoring."""
+        with self._lock:
+            mean = (self.search_seconds / self.searches
+                    if self.searches else None)
+            return {
+                "ready": self.ready,
+                "customers": len(self.customers),
+                "names": len(self.names),
+                "searches": self.searches,
+                "mean_search_us": (round(mean * 1e6, 1)
+                                   if mean is not None else None),
+                "max_search_us": round(self.max_search_seconds * 1e6, 1),
+            }
+
+
+customer_index = CustomerSearchIndex()
+
+
+def init_app(app, db):
+    """Build the customer typeahead index in the background and refresh it."""
+    if not app.config.get("CUSTOMER_SEARCH_INDEX_ENABLED", True):
+        return
+    interval = app.config.get(
+        "CUSTOMER_SEARCH_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS
+    )
+    run_periodically(
+        app, db, "customer-search-refresh", interval, customer_index.refresh
+    )
@@ -1,24 +1,173 @@
-from flask import Blueprint, request, jsonify
-from sqlalchemy import text
-from app import db
+import base64
+import io
+import json
+import time
+
+from flask import (
+    Blueprint, Response, current_app, jsonify, request, stream_with_context
+)
+from extensions import db
+from encoding import table
+from errors import error_response
+import customer_import
+from analytics import analytics
+from availability import allocator, locking
+from customer_search import COLUMNS as LOOKUP_COLUMNS
+from customer_search import customer_index
+from fanout import run_concurrently
+from purge import purger
+from queries import Statement
 
 customers_bp = Blueprint("customers", __name__, url_prefix="/api/customers")
 
 
+DEFAULT_PER_PAGE = 5
+MAX_PER_PAGE = 100
+CUSTOMER_COLUMNS = ["customer_id", "first_name", "last_name", "email", "store_id", "active"]
+COUNT_CACHE_SECONDS = 60
+COUNT_CACHE_SIZE = 1024
+LOOKUP_LIMIT = 10
+LOOKUP_MAX_LIMIT = 50
+
+# (customer_id, first_name, last_name) -> (total, cached_at)
+_count_cache = {}
+
+# Search filters shared by the customer list and its count
+CUSTOMER_FILTERS = {
+    "customer_id": " AND customer_id = :customer_id",
+    "first_name": " AND first_name LIKE :first_name",
+    "last_name": " AND last_name LIKE :last_name",
+}
+
+CUSTOMERS_QUERY = Statement(
+    "customers.list",
+    "SELECT " + ", ".join(CUSTOMER_COLUMNS) + """
+    FROM sakila.customer
+    WHERE 1=1{customer_id}{first_name}{last_name}{after}
+    ORDER BY customer_id DESC LIMIT :limit{offset}
+    """,
+    **CUSTOMER_FILTERS,
+    after=" AND customer_id < :after",
+    offset=" OFFSET :offset",
+)
+
+COUNT_QUERY = Statement(
+    "customers.count",
+    "SELECT COUNT(*) FROM sakila.customer WHERE 1=1{customer_id}{first_name}{last_name}",
+    **CUSTOMER_FILTERS,
+)
+
+INSERT_ADDRESS_QUERY = Statement("customers.insert_address", """
+    INSERT INTO sakila.address (address, address2, district, city_id, postal_code, phone, location)
+    VALUES (:address, :address2, :district, :city_id, :postal_code, :phone, ST_GeomFromText('POINT(0 0)'))
+""")
+
+INSERT_CUSTOMER_QUERY = Statement("customers.insert", """
+    INSERT INTO sakila.customer (store_id, first_name, last_name, email, address_id, active, create_date)
+    VALUES (:store_id, :first_name, :last_name, :email, :address_id, 1, NOW())
+""")
+
+LAST_INSERT_ID_QUERY = Statement("last_insert_id", "SELECT LAST_INSERT_ID()")
+
+DEACTIVATE_QUERY = Statement(
+    "customers.deactivate",
+    "UPDATE sakila.customer SET active = 0 WHERE customer_id = :customer_id",
+)
+
+CUSTOMER_DETAILS_QUERY = Statement("customers.details", """
+    SELECT c.customer_id, c.first_name, c.last_name, c.email,
+           c.store_id, c.active, a.address, a.address2,
+           a.district, a.postal_code, a.phone
+    FROM sakila.customer c
+    JOIN sakila.address a ON c.address_id = a.address_id
+    WHERE c.customer_id = :customer_id
+""")
+
+UPDATE_CUSTOMER_QUERY = Statement("customers.update", """
+    UPDATE sakila.customer
+    SET first_name = :first_name, last_name = :last_name, email = :email, store_id = :store_id
+    WHERE customer_id = :customer_id
+""")
+
+ADDRESS_ID_QUERY = Statement(
+    "customers.address_id",
+    "SELECT address_id FROM sakila.customer WHERE customer_id = :customer_id",
+)
+
+# Typeahead lookups until the in-memory customer index has been built
+LOOKUP_QUERY = Statement("customers.lookup", """
+    SELECT customer_id, first_name, last_name, email, store_id
+    FROM sakila.customer
+    WHERE active = 1
+      AND (first_name LIKE :prefix OR last_name LIKE :prefix OR email LIKE :prefix)
+    ORDER BY last_name, first_name, customer_id
+    LIMIT :limit
+""")
+
+UPDATE_ADDRESS_QUERY = Statement("customers.update_address", """
+    UPDATE sakila.address
+    SET address = :address, address2 = :address2, district = :district, city_id = :city_id,
+        postal_code = :postal_code, phone = :phone
+    WHERE address_id = :address_id
+""")
+
+
+def encode_cursor(position):
+    """Encodes a pagination position (a dict) into an opaque cursor token."""
+    raw = json.dumps(position).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *fields):
+    """Decodes a cursor token into its field values, or raises ValueError."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+        return tuple(position[field] for field in fields)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def count_customers(params, filter_key):
+    """Returns the number of customers matching the filters, cached briefly."""
+    now = time.time()
+    cached = _count_cache.get(filter_key)
+    if cached and now - cached[1] < COUNT_CACHE_SECONDS:
+        return cached[0]
+
+    total = COUNT_QUERY.execute(db.session, params).scalar()
+
+    if len(_count_cache) >= COUNT_CACHE_SIZE:
+        _count_cache.clear()
+    _count_cache[filter_key] = (total, now)
+    return total
+
+
+def invalidate_customer_counts():
+    """Drops cached totals after customers are added or removed."""
+    _count_cache.clear()
+
+
 @customers_bp.route("/", methods=["GET"])
 def get_customers():
-    """Retrieves paginated customers with optional search filters."""
+    """
+    Retrieves paginated customers with optional search filters.
+    Query parameters:
+      - page: page number for offset pagination (default 1)
+      - cursor: opaque token from a previous next_cursor; pass an empty
+        value to start cursor pagination from the newest customer
+      - per_page: page size, capped at MAX_PER_PAGE (default 5)
+      - include_total: if true, adds the (cached) total matching count
+      - customer_id, first_name, last_name: search filters
+      - format: "columnar" lists customers as columns plus value arrays
+    """
     try:
         page = request.args.get("page", 1, type=int)
-        per_page = 5
-        offset = (page - 1) * per_page
-
-        # Base query
-        query = """
-            SELECT customer_id, first_name, last_name, email, store_id, active
-            FROM sakila.customer
-            WHERE 1=1
-        """
+        per_page = request.args.get("per_page", DEFAULT_PER_PAGE, type=int)
+        per_page = max(1, min(per_page, MAX_PER_PAGE))
+        cursor = request.args.get("cursor")
+        include_total = request.args.get("include_total", "").lower() in ("1", "true", "yes")
+
         params = {}
 
         # Add filters if search parameters exist
@@ -27,43 +176,87 @@ def get_customers():
         last_name = request.args.get("last_name", "")
 
         if customer_id:
-            query += " AND customer_id = :customer_id"
             params["customer_id"] = customer_id
         if first_name:
-            query += " AND first_name LIKE :first_name"
             params["first_name"] = f"%{first_name}%"
         if last_name:
-            query += " AND last_name LIKE :last_name"
             params["last_name"] = f"%{last_name}%"
-
-        # Apply ordering, pagination
-        query += " ORDER BY customer_id DESC LIMIT :per_page OFFSET :offset"
-        params["per_page"] = per_page
-        params["offset"] = offset
-
-        result = db.session.execute(text(query), params).mappings().all()
-        customers = [dict(row) for row in result]
-
-        # Get total count for pagination
-        count_query = "SELECT COUNT(*) FROM sakila.customer WHERE 1=1"
-        if customer_id:
-            count_query += " AND customer_id = :customer_id"
-        if first_name:
-            count_query += " AND first_name LIKE :first_name"
-        if last_name:
-            count_query += " AND last_name LIKE :last_name"
-
-        total_customers = db.session.execute(text(count_query), params).scalar()
-        has_next = (page * per_page) < total_customers
-
-        return jsonify({
-            "customers": customers,
+        count_params = dict(params)
+
+        # Fetch one extra row to find out whether another page exists
+        params["limit"] = per_page + 1
+        if cursor is not None:
+            if cursor:
+                try:
+                    params["after"], = decode_cursor(cursor, "after")
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+                if not isinstance(params["after"], int):
+                    return jsonify({"error": "Invalid cursor"}), 400
+        else:
+            params["offset"] = max(page - 1, 0) * per_page
+
+        calls = [lambda: CUSTOMERS_QUERY.execute(db.session, params).mappings().all()]
+        if include_total:
+            # The total doesn't depend on the page, so count alongside it
+            filter_key = (customer_id, first_name, last_name)
+            calls.append(lambda: count_customers(count_params, filter_key))
+        result, *total = run_concurrently(*calls)
+
+        customers = result[:per_page]
+        has_next = len(result) > per_page
+
+        response = {
+            "customers": table(customers, CUSTOMER_COLUMNS),
             "has_next": has_next,
-            "current_page": page
-        })
+            "per_page": per_page,
+        }
+        if cursor is not None:
+            response["next_cursor"] = (
+                encode_cursor({"after": customers[-1]["customer_id"]})
+                if has_next else None
+            )
+        else:
+            response["current_page"] = page
+
+        if include_total:
+            response["total"] = total[0]
+
+        return jsonify(response)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+@customers_bp.route("/lookup", methods=["GET"])
+def lookup_customers():
+    """
+    Typeahead search over active customers' names and emails.
+    Query parameters:
+      - q: what has been typed so far; every word has to match the start
+        of a first name, last name or email (or, from three characters,
+        any part of a name)
+      - limit: number of matches, capped at LOOKUP_MAX_LIMIT (default 10)
+      - format: "columnar" lists customers as columns plus value arrays
+    Served from the in-memory customer index; until it has been built,
+    prefixes of the whole query are matched in SQL instead.
+    """
+    query = request.args.get("q", "").strip()
+    limit = request.args.get("limit", LOOKUP_LIMIT, type=int)
+    limit = max(1, min(limit, LOOKUP_MAX_LIMIT))
+    if not query:
+        return jsonify({"customers": table([], LOOKUP_COLUMNS)})
+
+    if customer_index.ready:
+        results = customer_index.search(query, limit)
+        return jsonify({"customers": table(results, LOOKUP_COLUMNS)})
 
+    try:
+        results = LOOKUP_QUERY.execute(db.session, {
+            "prefix": query + "%", "limit": limit,
+        }).mappings().all()
+        return jsonify({"customers": table(results, LOOKUP_COLUMNS)})
+    except Exception as e:
+        return error_response(e)
 
 
 @customers_bp.route("/", methods=["POST"])
@@ -92,12 +285,7 @@ def add_customer():
         # Start a transaction
         with db.session.begin():
             # Insert into address table
-            insert_address_query = text("""
-                INSERT INTO sakila.address (address, address2, district, city_id, postal_code, phone, location)
-                VALUES (:address, :address2, :district, :city_id, :postal_code, :phone, ST_GeomFromText('POINT(0 0)'))
-            """)
-
-            db.session.execute(insert_address_query, {
+            INSERT_ADDRESS_QUERY.execute(db.session, {
                 "address": address,
                 "address2": address2,
                 "district": district,
@@ -107,15 +295,10 @@ def add_customer():
             })
 
             # Retrieve the new address_id
-            address_id_query = text("SELECT LAST_INSERT_ID()")
-            address_id = db.session.execute(address_id_query).scalar()
+            address_id = LAST_INSERT_ID_QUERY.execute(db.session).scalar()
 
             # Insert into customer table
-            insert_customer = text("""
-                INSERT INTO sakila.customer (store_id, first_name, last_name, email, address_id, active, create_date)
-                VALUES (:store_id, :first_name, :last_name, :email, :address_id, 1, NOW())
-            """)
-            db.session.execute(insert_customer, {
+            INSERT_CUSTOMER_QUERY.execute(db.session, {
                 "store_id": store_id,
                 "first_name": first_name,
                 "last_name": last_name,
@@ -124,8 +307,16 @@ def add_customer():
             })
 
             # Retrieve the new customer_id
-            customer_id_query = text("SELECT LAST_INSERT_ID()")
-            customer_id = db.session.execute(customer_id_query).scalar()
+            customer_id = LAST_INSERT_ID_QUERY.execute(db.session).scalar()
+
+        invalidate_customer_counts()
+        customer_index.add({
+            "customer_id": customer_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "email": email,
+            "store_id": store_id,
+        })
 
         return jsonify({
             "message": "Customer added successfully",
@@ -134,74 +325,279 @@ def add_customer():
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+IMPORT_BUFFER_BYTES = 1 << 16
+# Upload formats by content type and file extension
+IMPORT_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+
+@customers_bp.route("/import", methods=["POST"])
+def import_customers():
+    """
+    Adds customers in bulk from a CSV (with a header row) or NDJSON upload,
+    sent as the request body (Content-Type text/csv or application/x-ndjson)
+    or as a multipart "file". Each row has the add_customer fields. Rows
+    are validated as the upload is read and inserted
+    CUSTOMER_IMPORT_CHUNK_ROWS at a time, each chunk in its own
+    transaction. Returns counts and the rows that failed, with the reason.
+    New customers reach the typeahead index with its next refresh.
+    """
+    try:
+        upload = request.files.get("file")
+        if upload is not None:
+            stream = upload.stream
+            extension = "." + (upload.filename or "").rsplit(".", 1)[-1].lower()
+            kind = IMPORT_FORMATS.get(upload.mimetype) or IMPORT_FORMATS.get(extension)
+        else:
+            # Reading lines from the raw WSGI stream is byte by byte
+            stream = io.BufferedReader(request.stream, IMPORT_BUFFER_BYTES)
+            kind = IMPORT_FORMATS.get(request.mimetype)
+        kind = request.args.get("format", kind)
+        if kind not in customer_import.READERS:
+            return jsonify({"error": "Upload CSV (text/csv) or NDJSON (application/x-ndjson)"}), 415
+
+        report = customer_import.import_customers(
+            db.session,
+            customer_import.READERS[kind](stream),
+            chunk_rows=current_app.config.get(
+                "CUSTOMER_IMPORT_CHUNK_ROWS", customer_import.DEFAULT_CHUNK_ROWS
+            ),
+            max_errors=current_app.config.get(
+                "CUSTOMER_IMPORT_MAX_ERRORS", customer_import.DEFAULT_MAX_ERRORS
+            ),
+        )
+        if report["imported"]:
+            invalidate_customer_counts()
+        return jsonify(report), 200 if report["imported"] or not report["failed"] else 400
+
+    except Exception as e:
+        db.session.rollback()
+        return error_response(e)
 
 
 @customers_bp.route("/<int:customer_id>", methods=["DELETE"])
 def delete_customer(customer_id):
-    """Deletes a customer and their associated rentals and payments."""
+    """
+    Deactivates a customer and queues the deletion of their payments,
+    rentals and customer row. A background worker deletes them in small
+    chunks; progress is at /purge-jobs/<job_id>. Until the job table
+    exists, the customer is deleted right away instead.
+    """
     try:
-        # Start a transaction
-        with db.session.begin():
-            # Step 1: Delete payments related to the customer
-            delete_payments = text("DELETE FROM sakila.payment WHERE customer_id = :customer_id")
-            db.session.execute(delete_payments, {"customer_id": customer_id})
-
-            # Step 2: Delete rentals related to the customer
-            delete_rentals = text("DELETE FROM sakila.rental WHERE customer_id = :customer_id")
-            db.session.execute(delete_rentals, {"customer_id": customer_id})
+        # Checked before any row is locked: it may probe on a separate
+        # connection
+        queued = purger.has_table(db.session)
+
+        # Deactivating locks the customer row, so concurrent deletes of the
+        # same customer queue one job between them
+        result = DEACTIVATE_QUERY.execute(db.session, {"customer_id": customer_id})
+        if result.rowcount == 0:
+            db.session.rollback()
+            return jsonify({"error": "Customer not found"}), 404
 
-            # Step 3: Delete the customer
-            delete_customer_query = text("DELETE FROM sakila.customer WHERE customer_id = :customer_id")
-            result = db.session.execute(delete_customer_query, {"customer_id": customer_id})
+        if not queued:
+            freed = purger.delete_now(db.session, customer_id)
+            db.session.commit()
+            for film_id, inventory_id in freed:
+                allocator.release(film_id, inventory_id)
+            customer_index.remove(customer_id)
+            invalidate_customer_counts()
+            return jsonify({"message": "Customer deleted successfully"}), 200
 
-            # Check if a customer was actually deleted
-            if result.rowcount == 0:
-                return jsonify({"error": "Customer not found"}), 404
+        job_id = purger.enqueue(db.session, customer_id)
+        db.session.commit()
+        customer_index.remove(customer_id)
+        invalidate_customer_counts()
 
-        return jsonify({"message": "Customer deleted successfully"}), 200
+        return jsonify({
+            "message": "Customer deletion scheduled",
+            "job_id": job_id,
+            "status_url": f"{customers_bp.url_prefix}/purge-jobs/{job_id}",
+        }), 202
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+@customers_bp.route("/purge-jobs/<int:job_id>", methods=["GET"])
+def get_purge_job(job_id):
+    """Reports the progress of a customer deletion."""
+    try:
+        job = purger.job(db.session, job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job)
+    except Exception as e:
+        return error_response(e)
+
+RENTAL_COLUMNS = ["rental_id", "film_id", "title", "rental_date", "return_date"]
+# A customer's rentals, newest first: a page after a (rental_date,
+# rental_id) position when before_date is given, all of them without limit
+RENTALS_QUERY = Statement(
+    "customers.rentals",
+    """
+    SELECT r.rental_id, f.film_id, f.title, r.rental_date, r.return_date
+    FROM sakila.rental r
+    JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+    JOIN sakila.film f ON i.film_id = f.film_id
+    WHERE r.customer_id = :customer_id{before_date}
+    ORDER BY r.rental_date DESC, r.rental_id DESC{limit}
+    """,
+    before_date="""
+      AND (r.rental_date < :before_date
+           OR (r.rental_date = :before_date AND r.rental_id < :before_id))""",
+    limit=" LIMIT :limit",
+)
+
+# Locking reads, so concurrent returns of a rental can't both count it
+RENTAL_CHECK_QUERY = Statement("rentals.check", """
+    SELECT r.return_date, r.inventory_id, i.film_id
+    FROM sakila.rental r
+    JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+    WHERE r.rental_id = :rental_id{for_update}
+""", for_update=" FOR UPDATE OF r")
+
+RETURN_RENTAL_QUERY = Statement("rentals.return", """
+    UPDATE sakila.rental
+    SET return_date = NOW()
+    WHERE rental_id = :rental_id AND return_date IS NULL
+""")
+
+BULK_RENTAL_CHECK_QUERY = Statement("rentals.check_many", """
+    SELECT r.rental_id, r.return_date, r.inventory_id, i.film_id
+    FROM sakila.rental r
+    JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+    WHERE r.rental_id IN :rental_ids{for_update}
+""", expanding=["rental_ids"], for_update=" FOR UPDATE OF r")
+
+BULK_RETURN_QUERY = Statement("rentals.return_many", """
+    UPDATE sakila.rental
+    SET return_date = NOW()
+    WHERE rental_id IN :rental_ids AND return_date IS NULL
+""", expanding=["rental_ids"])
+
+RENTAL_PER_PAGE = 20
+RENTAL_MAX_PER_PAGE = 500
+RENTAL_STREAM_CHUNK = 1000
+MAX_BULK_RETURNS = 500
+
+
+def get_rental_page(customer_id, cursor=None, per_page=RENTAL_PER_PAGE):
+    """
+    Returns one page of a customer's rentals, newest first, and the cursor
+    for the next page (None on the last page). Pages are keyed on
+    (rental_date, rental_id) so deep pages cost the same as the first.
+    """
+    params = {"customer_id": customer_id, "limit": per_page + 1}
+    if cursor:
+        params["before_date"], params["before_id"] = decode_cursor(
+            cursor, "rental_date", "rental_id"
+        )
+
+    result = RENTALS_QUERY.execute(db.session, params).mappings().all()
+    rentals = result[:per_page]
+
+    next_cursor = None
+    if len(result) > per_page:
+        last = rentals[-1]
+        next_cursor = encode_cursor({
+            "rental_date": str(last["rental_date"]),
+            "rental_id": last["rental_id"],
+        })
+    return rentals, next_cursor
+
 
 @customers_bp.route("/<int:customer_id>", methods=["GET"])
 def get_customer_details(customer_id):
-    """Retrieves customer details along with their rental history."""
+    """
+    Retrieves customer details along with the first page of their rental
+    history. Further pages come from /<customer_id>/rentals using
+    rental_history_next_cursor.
+    """
     try:
         # Fetch customer details
-        customer_query = text("""
-            SELECT c.customer_id, c.first_name, c.last_name, c.email, 
-                   c.store_id, c.active, a.address, a.address2, 
-                   a.district, a.postal_code, a.phone
-            FROM sakila.customer c
-            JOIN sakila.address a ON c.address_id = a.address_id
-            WHERE c.customer_id = :customer_id
-        """)
-        customer_result = db.session.execute(customer_query, {"customer_id": customer_id}).mappings().fetchone()
+        customer_result = CUSTOMER_DETAILS_QUERY.execute(db.session, {"customer_id": customer_id}).mappings().fetchone()
 
         if not customer_result:
             return jsonify({"error": "Customer not found"}), 404
 
         customer_details = dict(customer_result)
 
-        # Fetch rental history for the customer
-        rental_query = text("""
-            SELECT r.rental_id, f.film_id, f.title, r.rental_date, r.return_date
-            FROM sakila.rental r
-            JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
-            JOIN sakila.film f ON i.film_id = f.film_id
-            WHERE r.customer_id = :customer_id
-            ORDER BY r.rental_date DESC
-        """)
-        rental_results = db.session.execute(rental_query, {"customer_id": customer_id}).mappings().all()
-
-        customer_details["rental_history"] = [dict(row) for row in rental_results]
+        # Fetch the most recent rentals for the customer
+        rentals, next_cursor = get_rental_page(customer_id)
+        customer_details["rental_history"] = table(rentals, RENTAL_COLUMNS)
+        customer_details["rental_history_next_cursor"] = next_cursor
 
         return jsonify(customer_details)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+@customers_bp.route("/<int:customer_id>/rentals", methods=["GET"])
+def get_customer_rentals(customer_id):
+    """
+    Retrieves a customer's rental history one page at a time.
+    Query parameters:
+      - cursor: next_cursor from the previous page (omit for the first page)
+      - per_page: page size, capped at RENTAL_MAX_PER_PAGE (default 20)
+      - format: "columnar" lists rentals as columns plus value arrays
+    """
+    try:
+        cursor = request.args.get("cursor")
+        per_page = request.args.get("per_page", RENTAL_PER_PAGE, type=int)
+        per_page = max(1, min(per_page, RENTAL_MAX_PER_PAGE))
+
+        try:
+            rentals, next_cursor = get_rental_page(customer_id, cursor, per_page)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({
+            "rentals": table(rentals, RENTAL_COLUMNS),
+            "has_next": next_cursor is not None,
+            "next_cursor": next_cursor,
+        })
+    except Exception as e:
+        return error_response(e)
+
+
+@customers_bp.route("/<int:customer_id>/rentals.ndjson", methods=["GET"])
+def stream_customer_rentals(customer_id):
+    """
+    Streams a customer's full rental history as newline-delimited JSON.
+    Rows are read through a server-side cursor in chunks of
+    RENTAL_STREAM_CHUNK, so memory use does not grow with history size.
+    """
+    def generate():
+        result = RENTALS_QUERY.execute(
+            db.session,
+            {"customer_id": customer_id},
+            execution_options={
+                "stream_results": True,
+                "yield_per": RENTAL_STREAM_CHUNK,
+            },
+        ).mappings()
+        try:
+            for row in result:
+                yield current_app.json.dumps(dict(row)) + "\n"
+        finally:
+            result.close()
+
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
 
 @customers_bp.route("/<int:customer_id>", methods=["PUT"])
 def update_customer(customer_id):
@@ -229,12 +625,7 @@ def update_customer(customer_id):
         # Start transaction
         with db.session.begin():
             # Update customer details
-            update_customer_query = text("""
-                UPDATE sakila.customer 
-                SET first_name = :first_name, last_name = :last_name, email = :email, store_id = :store_id
-                WHERE customer_id = :customer_id
-            """)
-            db.session.execute(update_customer_query, {
+            UPDATE_CUSTOMER_QUERY.execute(db.session, {
                 "customer_id": customer_id,
                 "first_name": first_name,
                 "last_name": last_name,
@@ -243,20 +634,11 @@ def update_customer(customer_id):
             })
 
             # Get customer's address_id
-            address_id_query = text("""
-                SELECT address_id FROM sakila.customer WHERE customer_id = :customer_id
-            """)
-            address_id = db.session.execute(address_id_query, {"customer_id": customer_id}).scalar()
+            address_id = ADDRESS_ID_QUERY.execute(db.session, {"customer_id": customer_id}).scalar()
 
             if address_id:
                 # Update address details
-                update_address_query = text("""
-                    UPDATE sakila.address 
-                    SET address = :address, address2 = :address2, district = :district, city_id = :city_id, 
-                        postal_code = :postal_code, phone = :phone
-                    WHERE address_id = :address_id
-                """)
-                db.session.execute(update_address_query, {
+                UPDATE_ADDRESS_QUERY.execute(db.session, {
                     "address_id": address_id,
                     "address": address,
                     "address2": address2,
@@ -266,21 +648,30 @@ def update_customer(customer_id):
                     "phone": phone
                 })
 
+        # Name changes can move customers in or out of filtered totals
+        invalidate_customer_counts()
+        customer_index.update({
+            "customer_id": customer_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "email": email,
+            "store_id": store_id,
+        })
+
         return jsonify({"message": "Customer updated successfully"}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 @customers_bp.route("/return_rental/<int:rental_id>", methods=["PUT"])
 def return_rental(rental_id):
     """Marks a rental as returned by setting the return_date to the current timestamp."""
     try:
         # Check if the rental exists and hasn't been returned yet
-        rental_check_query = text("""
-            SELECT return_date FROM sakila.rental WHERE rental_id = :rental_id
-        """)
-        rental_result = db.session.execute(rental_check_query, {"rental_id": rental_id}).fetchone()
+        rental_result = RENTAL_CHECK_QUERY.execute(
+            db.session, {"rental_id": rental_id}, include=locking(db.session)
+        ).fetchone()
 
         if not rental_result:
             return jsonify({"error": "Rental not found"}), 404
@@ -290,17 +681,79 @@ def return_rental(rental_id):
             return jsonify({"error": "Rental already returned"}), 400
 
         # Update rental with return_date as current timestamp
-        update_rental_query = text("""
-            UPDATE sakila.rental 
-            SET return_date = NOW() 
-            WHERE rental_id = :rental_id
-        """)
-        db.session.execute(update_rental_query, {"rental_id": rental_id})
+        updated = RETURN_RENTAL_QUERY.execute(db.session, {"rental_id": rental_id}).rowcount
+        if not updated:
+            # Returned by a concurrent request since the check
+            db.session.rollback()
+            return jsonify({"error": "Rental already returned"}), 400
+        analytics.record_returns(db.session, [rental_id])
         db.session.commit()
 
+        # The copy can be rented again
+        allocator.release(rental_result.film_id, rental_result.inventory_id)
+
         return jsonify({"message": "Rental returned successfully"}), 200
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
 
+@customers_bp.route("/return_rentals", methods=["PUT"])
+def bulk_return_rentals():
+    """
+    Marks a batch of rentals as returned in one transaction.
+    Body: {"rental_ids": [...]}
+    Returns one result per rental_id, in request order.
+    """
+    try:
+        data = request.get_json()
+        rental_ids = data.get("rental_ids") if data else None
+
+        if not isinstance(rental_ids, list) or not rental_ids:
+            return jsonify({"error": "Missing rental_ids"}), 400
+        if len(rental_ids) > MAX_BULK_RETURNS:
+            return jsonify({"error": f"At most {MAX_BULK_RETURNS} returns per request"}), 400
+        if not all(isinstance(rental_id, int) for rental_id in rental_ids):
+            return jsonify({"error": "rental_ids must be integers"}), 400
+
+        # Check every rental in one query
+        rentals = {
+            row.rental_id: row
+            for row in BULK_RENTAL_CHECK_QUERY.execute(
+                db.session, {"rental_ids": rental_ids}, include=locking(db.session)
+            )
+        }
+
+        results = []
+        returning = {}
+        for rental_id in rental_ids:
+            rental = rentals.get(rental_id)
+            if not rental:
+                results.append({"rental_id": rental_id, "error": "Rental not found"})
+            elif rental.return_date is not None or rental_id in returning:
+                results.append({"rental_id": rental_id, "error": "Rental already returned"})
+            else:
+                returning[rental_id] = rental
+                results.append({"rental_id": rental_id, "message": "Rental returned successfully"})
+
+        if returning:
+            updated = BULK_RETURN_QUERY.execute(db.session, {"rental_ids": list(returning)}).rowcount
+            if updated != len(returning):
+                # Some were returned by a concurrent request since the check
+                db.session.rollback()
+                return jsonify({"error": "Rentals changed during the request, try again"}), 409
+            analytics.record_returns(db.session, list(returning))
+            db.session.commit()
+
+            # The copies can be rented again
+            for rental in returning.values():
+                allocator.release(rental.film_id, rental.inventory_id)
+        else:
+            db.session.rollback()
+
+        return jsonify({"results": results}), 200 if returning else 400
+
+    except Exception as e:
+        db.session.rollback()
+        return error_response(e)
@@ -0,0 +1,142 @@
+import gzip
+from collections.abc import Mapping
+
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy.engine import Row
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is used instead
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional; only gzip is offered without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = {"application/json", "application/x-ndjson",
+                      "text/csv", "text/plain"}
+DEFAULT_COMPRESSION_MIN_BYTES = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4
+
+
+def _default(o):
+    # Rows are serialized straight from the result, without the handler
+    # building a dict per row first
+    if isinstance(o, Mapping):
+        return dict(o)
+    if isinstance(o, Row):
+        return tuple(o)
+    return DefaultJSONProvider.default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson when it is installed.
+
+    Output matches Flask's provider value for value: dates are HTTP dates,
+    decimals are strings and keys are sorted. Non-ASCII text is written as
+    UTF-8 instead of \\u escapes. Result rows and row mappings can be passed
+    in directly. Debug (indented) output and calls with extra json.dumps
+    arguments go through the stdlib encoder.
+    """
+
+    default = staticmethod(_default)
+
+    def _options(self):
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def _encode(self, obj):
+        return orjson.dumps(obj, default=_default, option=self._options())
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj).decode()
+
+    def response(self, *args, **kwargs):
+        indent = (self.compact is None and self._app.debug) \
+            or self.compact is False
+        if orjson is None or indent:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            self._encode(obj) + b"\n", mimetype=self.mimetype
+        )
+
+
+def wants_columnar():
+    return request.args.get("format") == "columnar"
+
+
+def table(rows, columns=None):
+    """
+    Return a list of rows (mappings) in the shape the request asked for.
+    By default that is the rows themselves, serialized as one object per
+    row. With ?format=columnar it is {"columns": [...], "rows": [[...]]},
+    which names each column once. columns defaults to the keys of the
+    first row, so pass it explicitly where the result may be empty.
+    """
+    if not wants_columnar():
+        return rows
+    if columns is None:
+        columns = list(rows[0].keys()) if rows else []
+    return {
+        "columns": list(columns),
+        "rows": [[row[column] for column in columns] for row in rows],
+    }
+
+
+def _negotiate():
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding and request.accept_encodings[encoding] > 0:
+        return encoding
+    return None
+
+
+def compress_response(response):
+    """Gzip or brotli-encode JSON and text bodies the client accepts."""
+    config = current_app.config
+    if (not config.get("RESPONSE_COMPRESSION_ENABLED", True)
+            or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    min_bytes = config.get("RESPONSE_COMPRESSION_MIN_BYTES",
+                           DEFAULT_COMPRESSION_MIN_BYTES)
+    encoding = _negotiate() if len(body) >= min_bytes else None
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        body = brotli.compress(body, quality=config.get(
+            "RESPONSE_BROTLI_QUALITY", DEFAULT_BROTLI_QUALITY
+        ))
+    else:
+        body = gzip.compress(body, compresslevel=config.get(
+            "RESPONSE_GZIP_LEVEL", DEFAULT_GZIP_LEVEL
+        ), mtime=0)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+
+    # The encoded bytes differ from what the ETag was computed over
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """Install the fast JSON provider and response compression."""
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
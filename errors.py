@@ -0,0 +1,19 @@
+from flask import current_app, jsonify
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+
+def error_response(e):
+    """
+    Turns an exception raised in a handler into a JSON error response.
+    Running out of pooled database connections is reported as a 503 with
+    Retry-After so clients and load balancers back off; anything else is
+    a 500.
+    """
+    if isinstance(e, PoolTimeoutError):
+        response = jsonify({"error": "Database busy, try again shortly"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(
+            current_app.config.get("RETRY_AFTER_SECONDS", 1)
+        )
+        return response
+    return jsonify({"error": str(e)}), 500
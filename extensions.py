@@ -0,0 +1,8 @@
+from flask_sqlalchemy import SQLAlchemy
+
+from routing import RoutingSession
+
+# Bound to an app by create_app(); modules import db from here rather than
+# from app so they can be imported before (and without) an app existing.
+# Its sessions send read requests' SELECTs to a replica (see routing.py).
+db = SQLAlchemy(session_options={"class_": RoutingSession})
@@ -0,0 +1,257 @@
+import threading
+
+from sqlalchemy import text
+
+from background import run_periodically
+
+DEFAULT_REFRESH_SECONDS = 60
+
+FILMS_QUERY = text("""
+    SELECT f.film_id, f.title, f.release_year
+    FROM film f
+    WHERE f.last_update >= :since
+""")
+
+FILM_CATEGORIES_QUERY = text("""
+    SELECT fc.film_id, g.name
+    FROM film_category fc
+    JOIN category g ON fc.category_id = g.category_id
+""")
+
+FILM_ACTORS_QUERY = text("SELECT actor_id, film_id FROM film_actor")
+
+FILM_IDS_QUERY = text("SELECT film_id FROM film")
+ACTOR_IDS_QUERY = text("SELECT actor_id FROM actor")
+
+ACTORS_QUERY = text("""
+    SELECT actor_id, first_name, last_name
+    FROM actor
+    WHERE last_update >= :since
+""")
+
+# Row counts and newest last_update per table; if neither moved since the
+# last refresh there is nothing to do.
+WATERMARK_QUERY = text("""
+    SELECT 'film', COUNT(*), MAX(last_update) FROM film
+    UNION ALL SELECT 'actor', COUNT(*), MAX(last_update) FROM actor
+    UNION ALL SELECT 'category', COUNT(*), MAX(last_update) FROM category
+    UNION ALL SELECT 'film_actor', COUNT(*), MAX(last_update) FROM film_actor
+    UNION ALL
+    SELECT 'film_category', COUNT(*), MAX(last_update) FROM film_category
+""")
+
+# Lowest possible last_update, used to load everything on the first build.
+EPOCH = "1970-01-01 00:00:00"
+
+
+def trigrams(value):
+    """Return the set of lowercase 3-character substrings of value."""
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class TrigramIndex:
+    """Substring index over short strings keyed by id.
+
+    Matches have the same semantics as LIKE '%term%' under a case-insensitive
+    collation: posting lists of the term's trigrams are intersected to get
+    candidates, which are then checked with a plain substring test.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.postings = {}
+
+    def add(self, key, *values):
+        self.remove(key)
+        lowered = tuple(v.lower() for v in values if v)
+        self.values[key] = lowered
+        for value in lowered:
+            for gram in trigrams(value):
+                self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        for value in self.values.pop(key, ()):
+            for gram in trigrams(value):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.discard(key)
+                    if not posting:
+                        del self.postings[gram]
+
+    def search(self, term):
+        term = term.lower()
+        grams = trigrams(term)
+        if grams:
+            lists = sorted(
+                (self.postings.get(g, ()) for g in grams), key=len
+            )
+            if not lists[0]:
+                return set()
+            candidates = set(lists[0]).intersection(*lists[1:])
+        else:
+            # Terms under three characters have no trigrams; the indexed
+            # vocabularies (titles, names, genres) are small enough to scan.
+            candidates = self.values.keys()
+        return {
+            key for key in candidates
+            if any(term in value for value in self.values[key])
+        }
+
+
+class FilmSearchIndex:
+    """In-memory inverted index answering the /films search filters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.films = {}
+        self.film_genres = {}
+        self.genre_films = {}
+        self.actor_films = {}
+        self.titles = TrigramIndex()
+        self.actors = TrigramIndex()
+        self.genres = TrigramIndex()
+        self.ready = False
+        self._watermarks = None
+        self._since = EPOCH
+
+    def refresh(self, session):
+        """Bring the index up to date with the film and actor tables.
+
+        Only films and actors whose last_update moved are re-read, and
+        their ids are compared with the index to drop deleted ones (a
+        delete and an insert between refreshes leave the row count alone).
+        The small film_actor and film_category link tables are re-read
+        whenever they change, and anything that shrinks triggers a full
+        rebuild.
+        """
+        rows = session.execute(WATERMARK_QUERY).all()
+        watermarks = {row[0]: (row[1], row[2]) for row in rows}
+        if watermarks == self._watermarks:
+            return
+
+        since = self._since
+        previous = self._watermarks or {}
+        if any(watermarks[t][0] < previous.get(t, (0, None))[0]
+               for t in watermarks):
+            since = EPOCH
+        newest = max(
+            (str(w[1]) for w in watermarks.values() if w[1] is not None),
+            default=EPOCH,
+        )
+
+        films = session.execute(FILMS_QUERY, {"since": since}).mappings().all()
+        actors = session.execute(
+            ACTORS_QUERY, {"since": since}
+        ).mappings().all()
+        film_ids = set(session.execute(FILM_IDS_QUERY).scalars())
+        actor_ids = set(session.execute(ACTOR_IDS_QUERY).scalars())
+        film_genres = {}
+        genre_films = {}
+        for film_id, name in session.execute(FILM_CATEGORIES_QUERY):
+            film_genres.setdefault(film_id, []).append(name)
+            genre_films.setdefault(name, set()).add(film_id)
+        actor_films = {}
+        for actor_id, film_id in session.execute(FILM_ACTORS_QUERY):
+            actor_films.setdefault(actor_id, set()).add(film_id)
+
+        with self._lock:
+            if since == EPOCH:
+                self.films = {}
+                self.titles = TrigramIndex()
+                self.actors = TrigramIndex()
+            for film_id in self.films.keys() - film_ids:
+                del self.films[film_id]
+                self.titles.remove(film_id)
+            for actor_id in self.actors.values.keys() - actor_ids:
+                self.actors.remove(actor_id)
+            for row in films:
+                self.films[row["film_id"]] = dict(row)
+                self.titles.add(row["film_id"], row["title"])
+            for row in actors:
+                self.actors.add(
+                    row["actor_id"], row["first_name"], row["last_name"]
+                )
+            genres = TrigramIndex()
+            for name in genre_films:
+                genres.add(name, name)
+            self.genres = genres
+            self.film_genres = film_genres
+            self.genre_films = genre_films
+            self.actor_films = actor_films
+            self._watermarks = watermarks
+            # Re-read rows touched in the same second as the watermark next
+            # time rather than risk missing them.
+            self._since = newest
+            self.ready = True
+
+    def search(self, film="", actor="", genre=""):
+        """Return matching (film, genre) rows ranked by title relevance."""
+        with self._lock:
+            film_ids = None
+            if film:
+                film_ids = self.titles.search(film)
+            if actor:
+                matched = set()
+                for actor_id in self.actors.search(actor):
+                    matched |= self.actor_films.get(actor_id, set())
+                film_ids = matched if film_ids is None else film_ids & matched
+            genre_names = None
+            if genre:
+                genre_names = self.genres.search(genre)
+                matched = set()
+                for name in genre_names:
+                    matched |= self.genre_films[name]
+                film_ids = matched if film_ids is None else film_ids & matched
+            if film_ids is None:
+                film_ids = self.films.keys()
+
+            results = []
+            for film_id in film_ids:
+                info = self.films.get(film_id)
+                if info is None:
+                    continue
+                names = self.film_genres.get(film_id) or [None]
+                for name in names:
+                    if genre_names is not None and name not in genre_names:
+                        continue
+                    results.append({
+                        "film_id": film_id,
+                        "title": info["title"],
+                        "release_year": info["release_year"],
+                        "genre": name,
+                    })
+
+        term = film.lower()
+        results.sort(key=lambda r: (_rank(r["title"], term), r["title"],
+                                    r["film_id"], r["genre"] or ""))
+        return results
+
+
+def _rank(title, term):
+    """Exact title matches first, then prefix, then word-prefix, then rest."""
+    if not term:
+        return 0
+    title = title.lower()
+    if title == term:
+        return 0
+    if title.startswith(term):
+        return 1
+    if f" {term}" in title:
+        return 2
+    return 3
+
+
+search_index = FilmSearchIndex()
+
+
+def init_app(app, db):
+    """Build the search index in the background and keep it refreshed."""
+    if not app.config.get("FILM_SEARCH_INDEX_ENABLED", True):
+        return
+    interval = app.config.get(
+        "FILM_SEARCH_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS
+    )
+    run_periodically(
+        app, db, "film-search-refresh", interval, search_index.refresh
+    )
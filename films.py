@@ -1,73 +1,209 @@
-from flask import Blueprint, jsonify, request
-from sqlalchemy import text
-from app import db  # Import the db from the main app
+from flask import Blueprint, current_app, jsonify, request
+from extensions import db
+from encoding import table, wants_columnar
+from errors import error_response
+from leaderboard import leaderboard
+from film_search import search_index
+from availability import allocator, locking
+from fanout import run_concurrently
+from queries import Statement
+from rental_rollup import ACTOR_TOP_FILMS_QUERY as ROLLUP_TOP_FILMS_QUERY
+from rental_rollup import rollup
+from analytics import analytics
+from response_cache import actor_cache, cached_response, film_cache
+from singleflight import actor_flight, coalesced_response, film_flight, search_flight
 
 films_bp = Blueprint('films', __name__)
 
+SEARCH_PER_PAGE = 50
+SEARCH_MAX_PER_PAGE = 100
+SEARCH_COLUMNS = ["film_id", "title", "release_year", "genre"]
+MAX_BULK_RENTALS = 500
+
+# last_update of every row film_details reads; the cached response is
+# rebuilt when any of them moves
+FILM_VERSION_QUERY = Statement("film.version", """
+    SELECT f.last_update,
+           (SELECT l.last_update FROM language l WHERE l.language_id = f.language_id),
+           (SELECT MAX(fa.last_update) FROM film_actor fa WHERE fa.film_id = f.film_id),
+           (SELECT COUNT(*) FROM film_actor fa WHERE fa.film_id = f.film_id),
+           (SELECT MAX(a.last_update) FROM actor a
+            JOIN film_actor fa ON a.actor_id = fa.actor_id
+            WHERE fa.film_id = f.film_id)
+    FROM film f
+    WHERE f.film_id = :film_id
+""")
+
+ACTOR_VERSION_QUERY = Statement("actor.version", """
+    SELECT a.last_update,
+           (SELECT MAX(fa.last_update) FROM film_actor fa WHERE fa.actor_id = a.actor_id),
+           (SELECT COUNT(*) FROM film_actor fa WHERE fa.actor_id = a.actor_id),
+           (SELECT MAX(f.last_update) FROM film f
+            JOIN film_actor fa ON f.film_id = fa.film_id
+            WHERE fa.actor_id = a.actor_id)
+    FROM actor a
+    WHERE a.actor_id = :actor_id
+""")
+
+ACTOR_FILMS_QUERY = Statement(
+    "actor.film_ids", "SELECT film_id FROM film_actor WHERE actor_id = :actor_id"
+)
+
+FILM_QUERY = Statement("film.details", """
+    SELECT f.film_id, f.title, f.description, f.release_year, l.name AS language, f.rating
+    FROM film f
+    JOIN language l ON f.language_id = l.language_id
+    WHERE f.film_id = :film_id
+""")
+
+FILM_ACTORS_QUERY = Statement("film.actors", """
+    SELECT a.actor_id, a.first_name, a.last_name
+    FROM actor a
+    JOIN film_actor fa ON a.actor_id = fa.actor_id
+    WHERE fa.film_id = :film_id
+""")
+
+ACTOR_QUERY = Statement("actor.details", """
+    SELECT a.actor_id, a.first_name, a.last_name, COUNT(fa.film_id) AS film_count
+    FROM actor a
+    JOIN film_actor fa ON a.actor_id = fa.actor_id
+    WHERE a.actor_id = :actor_id
+    GROUP BY a.actor_id, a.first_name, a.last_name
+""")
+
+# Top 5 rented films by the actor
+ACTOR_TOP_FILMS_QUERY = Statement("actor.top_films", """
+    SELECT f.film_id, f.title, COUNT(r.rental_id) AS rental_count
+    FROM film f
+    JOIN film_actor fa ON f.film_id = fa.film_id
+    JOIN inventory i ON f.film_id = i.film_id
+    JOIN rental r ON i.inventory_id = r.inventory_id
+    WHERE fa.actor_id = :actor_id
+    GROUP BY f.film_id, f.title
+    ORDER BY rental_count DESC
+    LIMIT 5
+""")
+
+# SQL fallback of search_films; each filter is only added when given
+SEARCH_QUERY = Statement(
+    "films.search",
+    """
+    SELECT DISTINCT f.film_id, f.title, f.release_year, g.name AS genre
+    FROM film f
+    LEFT JOIN film_actor fa ON f.film_id = fa.film_id
+    LEFT JOIN actor a ON fa.actor_id = a.actor_id
+    LEFT JOIN film_category fc ON f.film_id = fc.film_id
+    LEFT JOIN category g ON fc.category_id = g.category_id
+    WHERE 1=1{film}{actor}{genre}
+    ORDER BY f.title LIMIT :limit OFFSET :offset
+    """,
+    film=" AND f.title LIKE :film",
+    actor=" AND (a.first_name LIKE :actor OR a.last_name LIKE :actor)",
+    genre=" AND g.name LIKE :genre",
+)
+
+RENT_QUERY = Statement("rentals.rent", """
+    INSERT INTO rental (rental_date, inventory_id, customer_id, return_date, staff_id)
+    VALUES (NOW(), :inventory_id, :customer_id, NULL, 1)
+""")
+
+# Locking read: a customer being deleted is deactivated first, and must not
+# rent anything while the purge runs
+ACTIVE_CUSTOMERS_QUERY = Statement("rentals.active_customers", """
+    SELECT customer_id FROM customer
+    WHERE customer_id IN :customer_ids AND active = 1{for_update}
+""", expanding=["customer_ids"], for_update=" FOR UPDATE")
+
+# Each rented copy has exactly one open rental
+OPEN_RENTALS_QUERY = Statement("rentals.open_by_inventory", """
+    SELECT inventory_id, rental_id FROM rental
+    WHERE inventory_id IN :inventory_ids AND return_date IS NULL
+""", expanding=["inventory_ids"])
+
+
+def load_version(query, params):
+    row = query.execute(db.session, params).fetchone()
+    return tuple(row) if row else None
+
+
 @films_bp.route('/film/<int:film_id>', methods=['GET'])
 def film_details(film_id):
-    """Fetch details for a specific film along with its actors."""
+    """
+    Fetch details for a specific film along with its actors. Responses are
+    cached and carry ETag, Last-Modified and Cache-Control headers;
+    concurrent requests for the same film share one cache lookup.
+    """
     try:
-        # Fetch film details
-        film_query = text("""
-            SELECT f.film_id, f.title, f.description, f.release_year, l.name AS language, f.rating
-            FROM film f
-            JOIN language l ON f.language_id = l.language_id
-            WHERE f.film_id = :film_id
-        """)
-        film_result = db.session.execute(film_query, {"film_id": film_id}).mappings().fetchone()
+        return coalesced_response(film_flight, film_id, lambda: cached_response(
+            film_cache, film_id,
+            load_version=lambda: load_version(FILM_VERSION_QUERY, {"film_id": film_id}),
+            render=lambda: render_film_details(film_id),
+            max_age=current_app.config.get("FILM_CACHE_MAX_AGE", 300),
+        ))
+    except Exception as e:
+        return error_response(e)
+
+
+def render_film_details(film_id):
+    """Build the film_details response from the database."""
+    try:
+        # Both queries only depend on film_id, so run them side by side
+        film_result, actor_results = run_concurrently(
+            lambda: FILM_QUERY.execute(db.session, {"film_id": film_id}).mappings().fetchone(),
+            lambda: FILM_ACTORS_QUERY.execute(db.session, {"film_id": film_id}).mappings().all(),
+        )
         
         if not film_result:
             return jsonify({"error": "Film not found"}), 404
 
         film_details = dict(film_result)
-
-        # Fetch actors for the film
-        actor_query = text("""
-            SELECT a.actor_id, a.first_name, a.last_name
-            FROM actor a
-            JOIN film_actor fa ON a.actor_id = fa.actor_id
-            WHERE fa.film_id = :film_id
-        """)
-        actor_results = db.session.execute(actor_query, {"film_id": film_id}).mappings().all()
         film_details["actors"] = [dict(row) for row in actor_results]
 
         return jsonify(film_details)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 @films_bp.route('/actor/<int:actor_id>', methods=['GET'])
 def actor_details(actor_id):
-    """Fetch details for a specific actor and their top 5 rented films."""
+    """
+    Fetch details for a specific actor and their top 5 rented films.
+    Responses are cached like film_details; rentals made in this worker
+    drop the entry at once, rentals elsewhere within ACTOR_CACHE_MAX_STALE.
+    Concurrent requests for the same actor share one cache lookup.
+    """
     try:
-        # Query for actor details
-        actor_query = text("""
-            SELECT a.actor_id, a.first_name, a.last_name, COUNT(fa.film_id) AS film_count
-            FROM actor a
-            JOIN film_actor fa ON a.actor_id = fa.actor_id
-            WHERE a.actor_id = :actor_id
-            GROUP BY a.actor_id, a.first_name, a.last_name
-        """)
-        actor_result = db.session.execute(actor_query, {"actor_id": actor_id}).mappings().fetchone()
+        return coalesced_response(actor_flight, actor_id, lambda: cached_response(
+            actor_cache, actor_id,
+            load_version=lambda: load_version(ACTOR_VERSION_QUERY, {"actor_id": actor_id}),
+            render=lambda: render_actor_details(actor_id),
+            max_age=current_app.config.get("ACTOR_CACHE_MAX_AGE", 30),
+            max_stale=current_app.config.get("ACTOR_CACHE_MAX_STALE", 60),
+            load_film_ids=lambda: ACTOR_FILMS_QUERY.execute(
+                db.session, {"actor_id": actor_id}
+            ).scalars().all(),
+        ))
+    except Exception as e:
+        return error_response(e)
+
+
+def render_actor_details(actor_id):
+    """Build the actor_details response from the database."""
+    try:
+        films_query = ACTOR_TOP_FILMS_QUERY
+
+        # Indexed lookup once the rental rollup has been built
+        if rollup.is_ready(db.session):
+            films_query = ROLLUP_TOP_FILMS_QUERY
+
+        actor_result, films_result = run_concurrently(
+            lambda: ACTOR_QUERY.execute(db.session, {"actor_id": actor_id}).mappings().fetchone(),
+            lambda: films_query.execute(db.session, {"actor_id": actor_id}).mappings().all(),
+        )
 
         if not actor_result:
             return jsonify({"error": "Actor not found"}), 404
         
-        # Query for top 5 rented films by the actor
-        films_query = text("""
-            SELECT f.film_id, f.title, COUNT(r.rental_id) AS rental_count
-            FROM film f
-            JOIN film_actor fa ON f.film_id = fa.film_id
-            JOIN inventory i ON f.film_id = i.film_id
-            JOIN rental r ON i.inventory_id = r.inventory_id
-            WHERE fa.actor_id = :actor_id
-            GROUP BY f.film_id, f.title
-            ORDER BY rental_count DESC
-            LIMIT 5
-        """)
-        films_result = db.session.execute(films_query, {"actor_id": actor_id}).mappings().all()
-        
         # Combine actor details with their top 5 films
         actor_details = dict(actor_result)
         actor_details["top_rented_films"] = [dict(row) for row in films_result]
@@ -75,7 +211,7 @@ def actor_details(actor_id):
         return jsonify(actor_details)
     
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 @films_bp.route('/films', methods=['GET'])
 def search_films():
@@ -85,41 +221,57 @@ def search_films():
       - film: (partial) film title
       - actor: (partial) actor's first or last name
       - genre: (partial) genre name
+      - page: page number (default 1)
+      - per_page: results per page (default 50, at most 100)
+      - format: "columnar" for {"columns": [...], "rows": [[...]]}
+    Results come from the in-memory search index, ranked by how well the
+    title matches; the total match count is returned in X-Total-Count.
+    Concurrent identical searches (ignoring case) run once.
     """
     film = request.args.get('film', '')
     actor = request.args.get('actor', '')
     genre = request.args.get('genre', '')
-    
-    # Base SQL query
-    query = """
-        SELECT DISTINCT f.film_id, f.title, f.release_year, g.name AS genre
-        FROM film f
-        LEFT JOIN film_actor fa ON f.film_id = fa.film_id
-        LEFT JOIN actor a ON fa.actor_id = a.actor_id
-        LEFT JOIN film_category fc ON f.film_id = fc.film_id
-        LEFT JOIN category g ON fc.category_id = g.category_id
-        WHERE 1=1
-    """
-    
-    params = {}
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = request.args.get('per_page', SEARCH_PER_PAGE, type=int)
+    per_page = max(1, min(per_page, SEARCH_MAX_PER_PAGE))
+    offset = (page - 1) * per_page
+
+    key = (film.lower(), actor.lower(), genre.lower(), offset, per_page,
+           wants_columnar())
+    return coalesced_response(search_flight, key, lambda: render_search_films(
+        film, actor, genre, offset, per_page
+    ))
+
+
+def render_search_films(film, actor, genre, offset, per_page):
+    """Build the search_films response from the index or the database."""
+    if search_index.ready:
+        results = search_index.search(film=film, actor=actor, genre=genre)
+        response = jsonify(table(results[offset:offset + per_page], SEARCH_COLUMNS))
+        response.headers['X-Total-Count'] = str(len(results))
+        return response
+
+    # Fall back to SQL until the index has been built
+    params = {'limit': per_page, 'offset': offset}
     if film:
-        query += " AND f.title LIKE :film"
         params['film'] = f"%{film}%"
     if actor:
-        query += " AND (a.first_name LIKE :actor OR a.last_name LIKE :actor)"
         params['actor'] = f"%{actor}%"
     if genre:
-        query += " AND g.name LIKE :genre"
         params['genre'] = f"%{genre}%"
-    
-    query += " LIMIT 50"
-    
+
     try:
-        result = db.session.execute(text(query), params).mappings().all()
-        films = [dict(row) for row in result]
-        return jsonify(films)
+        result = SEARCH_QUERY.execute(db.session, params).mappings().all()
+        return jsonify(table(result, SEARCH_COLUMNS))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def active_customers(session, customer_ids):
+    """The active ones of customer_ids, locked until the caller commits."""
+    return set(ACTIVE_CUSTOMERS_QUERY.execute(
+        session, {"customer_ids": sorted(set(customer_ids))}, include=locking(session)
+    ).scalars())
+
 
 @films_bp.route('/rentals/rent', methods=['POST'])
 def rent_film():
@@ -131,31 +283,120 @@ def rent_film():
 
         if not customer_id or not film_id:
             return jsonify({"error": "Missing customer_id or film_id"}), 400
+        try:
+            customer_id, film_id = int(customer_id), int(film_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid customer_id or film_id"}), 400
 
-        # Check if there's an available copy of the film
-        availability_query = text("""
-            SELECT i.inventory_id FROM inventory i
-            LEFT JOIN rental r ON i.inventory_id = r.inventory_id AND r.return_date IS NULL
-            WHERE i.film_id = :film_id AND r.inventory_id IS NULL
-            LIMIT 1
-        """)
-        inventory_result = db.session.execute(availability_query, {"film_id": film_id}).mappings().fetchone()
+        if not active_customers(db.session, [customer_id]):
+            db.session.rollback()
+            return jsonify({"error": "Customer not found or inactive"}), 400
 
-        if not inventory_result:
-            return jsonify({"error": "No available copies for this film"}), 400
+        # Reserve an available copy of the film
+        inventory_id = allocator.allocate(db.session, film_id)
 
-        inventory_id = inventory_result["inventory_id"]
+        if not inventory_id:
+            db.session.rollback()
+            return jsonify({"error": "No available copies for this film"}), 400
 
         # Insert rental record
-        rent_query = text("""
-            INSERT INTO rental (rental_date, inventory_id, customer_id, return_date, staff_id)
-            VALUES (NOW(), :inventory_id, :customer_id, NULL, 1)
-        """)
-        db.session.execute(rent_query, {"inventory_id": inventory_id, "customer_id": customer_id})
-        db.session.commit()
+        try:
+            RENT_QUERY.execute(db.session, {"inventory_id": inventory_id, "customer_id": customer_id})
+            rollup.record(db.session, [film_id])
+            analytics.record_rentals(db.session, [inventory_id])
+            db.session.commit()
+        except Exception:
+            allocator.release(film_id, inventory_id)
+            raise
+        allocator.confirm(inventory_id)
+        leaderboard.record_rental(film_id)
+        actor_cache.invalidate_film(film_id)
 
         return jsonify({"message": "Rental successful", "inventory_id": inventory_id}), 201
     
     except Exception as e:
         db.session.rollback()
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+@films_bp.route('/rentals/rent/bulk', methods=['POST'])
+def bulk_rent_films():
+    """
+    Rents a batch of films in one transaction.
+    Body: {"rentals": [{"customer_id": ..., "film_id": ...}, ...]}
+    Returns one result per requested rental, in request order.
+    """
+    try:
+        data = request.get_json()
+        items = data.get("rentals") if data else None
+
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Missing rentals"}), 400
+        if len(items) > MAX_BULK_RENTALS:
+            return jsonify({"error": f"At most {MAX_BULK_RENTALS} rentals per request"}), 400
+
+        results = [None] * len(items)
+        valid = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get("customer_id") or not item.get("film_id"):
+                results[i] = {"error": "Missing customer_id or film_id"}
+                continue
+            try:
+                items[i] = {"customer_id": int(item["customer_id"]),
+                            "film_id": int(item["film_id"])}
+            except (TypeError, ValueError):
+                results[i] = {"error": "Invalid customer_id or film_id"}
+                continue
+            valid.append(i)
+
+        active = active_customers(db.session, [items[i]["customer_id"] for i in valid])
+        for i in valid:
+            if items[i]["customer_id"] not in active:
+                results[i] = {"error": "Customer not found or inactive"}
+        valid = [i for i in valid if items[i]["customer_id"] in active]
+
+        # Reserve copies for every film in the batch at once
+        inventory_ids = allocator.allocate_many(db.session, [items[i]["film_id"] for i in valid])
+
+        rows = []
+        for i, inventory_id in zip(valid, inventory_ids):
+            if inventory_id is None:
+                results[i] = {"error": "No available copies for this film"}
+            else:
+                rows.append((i, inventory_id))
+
+        if rows:
+            try:
+                RENT_QUERY.execute(db.session, [
+                    {"inventory_id": inventory_id, "customer_id": items[i]["customer_id"]}
+                    for i, inventory_id in rows
+                ])
+                rollup.record(db.session, [items[i]["film_id"] for i, _ in rows])
+                analytics.record_rentals(db.session, [inventory_id for _, inventory_id in rows])
+
+                rental_ids = dict(OPEN_RENTALS_QUERY.execute(db.session, {
+                    "inventory_ids": [inventory_id for _, inventory_id in rows]
+                }).all())
+                db.session.commit()
+            except Exception:
+                for i, inventory_id in rows:
+                    allocator.release(items[i]["film_id"], inventory_id)
+                raise
+        else:
+            db.session.rollback()
+
+        allocator.confirm(*(inventory_id for _, inventory_id in rows))
+        for i, inventory_id in rows:
+            leaderboard.record_rental(items[i]["film_id"])
+            actor_cache.invalidate_film(items[i]["film_id"])
+            results[i] = {
+                "message": "Rental successful",
+                "inventory_id": inventory_id,
+                "rental_id": rental_ids.get(inventory_id),
+            }
+
+        return jsonify({"results": results}), 201 if rows else 400
+
+    except Exception as e:
+        db.session.rollback()
+        return error_response(e)
@@ -0,0 +1,23 @@
+"""
+Pre-fork deployment: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported and built once in the master (preload_app) and shared
+copy-on-write by the workers. Each worker then starts its own background
+jobs and warm-up after the fork.
+"""
+import os
+
+os.environ.setdefault("SAKILA_PREFORK", "1")
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+preload_app = True
+
+
+def post_fork(server, worker):
+    import startup
+    import wsgi
+
+    startup.start(wsgi.app)
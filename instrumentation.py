@@ -0,0 +1,308 @@
+import bisect
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Blueprint, Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+STATEMENT_LABEL_LENGTH = 120
+
+slow_query_log = logging.getLogger("sakila.slow_query")
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+class Histogram:
+    """Prometheus-style histogram with fixed buckets, keyed by label set."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0
+                ]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append(f"{self.name}_bucket"
+                                 f"{_labels(labels, le=le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter keyed by label set."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Prometheus-style gauge keyed by label set."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(labels)} {value}")
+        return lines
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", " "))
+        for key, value in pairs
+    )
+    return "{" + body + "}"
+
+
+request_latency = Histogram(
+    "http_request_duration_seconds", "Request latency by route.",
+    LATENCY_BUCKETS,
+)
+request_queries = Histogram(
+    "http_request_sql_queries", "SQL statements executed per request.",
+    QUERY_COUNT_BUCKETS,
+)
+statement_latency = Histogram(
+    "sql_statement_duration_seconds", "SQL statement latency.",
+    LATENCY_BUCKETS,
+)
+statement_rows = Counter(
+    "sql_statement_rows_total", "Rows returned or affected by statement."
+)
+route_rows = Counter(
+    "http_request_sql_rows_total", "Rows returned or affected by route."
+)
+statement_errors = Counter(
+    "sql_statement_errors_total", "SQL statements that raised an error."
+)
+slow_queries = Counter(
+    "sql_slow_queries_total",
+    "Statements slower than the slow-query threshold.",
+)
+
+REGISTRY = [request_latency, request_queries, statement_latency,
+            statement_rows, route_rows, statement_errors, slow_queries]
+
+
+def register(*metrics):
+    """Expose metrics defined by other modules at /metrics."""
+    REGISTRY.extend(metrics)
+
+
+_explain_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="slow-query-explain"
+)
+
+
+def statement_label(statement, context=None):
+    """
+    The name a registered statement was declared with (see queries.py),
+    otherwise the SQL with whitespace collapsed so the same statement
+    always gets one label.
+    """
+    if context is not None:
+        name = context.execution_options.get("statement_name")
+        if name:
+            return name
+    label = re.sub(r"\s+", " ", statement).strip()
+    return label[:STATEMENT_LABEL_LENGTH]
+
+
+class RequestStats:
+    """SQL activity attributed to the current request."""
+
+    def __init__(self, route):
+        self.route = route
+        self.queries = 0
+        self.rows = 0
+
+
+def current_request_stats():
+    if has_app_context():
+        return g.get("sql_request_stats")
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    label = (("statement", statement_label(statement, context)),)
+    statement_latency.observe(label, elapsed)
+
+    # Unbuffered (streaming) cursors don't know their row count up front
+    rows = cursor.rowcount
+    if rows is None or rows < 0 or rows >= 2 ** 32:
+        rows = 0
+    statement_rows.inc(label, rows)
+
+    stats = current_request_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.rows += rows
+
+    if not has_app_context():
+        return
+    config = current_app.config
+    threshold = config.get("SLOW_QUERY_MS", 200) / 1000
+    if elapsed >= threshold:
+        slow_queries.inc(label)
+        _log_slow_query(conn.engine, label[0][1], statement, parameters,
+                        elapsed, stats.route if stats else None,
+                        config.get("SLOW_QUERY_EXPLAIN", False),
+                        config.get("SLOW_QUERY_LOG_PARAMS", False))
+
+
+def _handle_error(context):
+    conn = context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+    statement = context.statement or ""
+    label = statement_label(statement, context.execution_context)
+    statement_errors.inc((("statement", label),))
+
+
+def _redact(parameters):
+    """parameters with every value replaced by its type name."""
+    if isinstance(parameters, dict):
+        return {name: _redact(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return type(parameters)(_redact(value) for value in parameters)
+    return f"<{type(parameters).__name__}>"
+
+
+def _log_slow_query(engine, label, statement, parameters, elapsed, route,
+                    explain, log_params):
+    message = "%.1f ms route=%s statement=%s sql=%s params=%r"
+    # Values can be passwords or personal data; only log them on request
+    args = (elapsed * 1000, route, label, statement_label(statement),
+            parameters if log_params else _redact(parameters))
+    is_select = statement.lstrip().upper().startswith("SELECT")
+    if not (explain and is_select):
+        slow_query_log.warning(message, *args)
+        return
+
+    # EXPLAIN runs on its own connection off the request path
+    def run_explain():
+        try:
+            with engine.connect() as conn:
+                plan = conn.exec_driver_sql(
+                    "EXPLAIN " + statement, parameters
+                ).mappings().all()
+            slow_query_log.warning(message + " plan=%r", *args,
+                                   [dict(row) for row in plan])
+        except Exception as e:
+            slow_query_log.warning(message + " explain_error=%s", *args, e)
+
+    _explain_executor.submit(run_explain)
+
+
+def _start_request():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.sql_request_stats = RequestStats(route)
+    g.request_started = time.perf_counter()
+
+
+def _finish_request(response):
+    stats = g.get("sql_request_stats")
+    started = g.get("request_started")
+    if stats is None or started is None:
+        return response
+    labels = (("route", stats.route), ("method", request.method))
+    request_latency.observe(
+        labels + (("status", response.status_code),),
+        time.perf_counter() - started,
+    )
+    request_queries.observe(labels, stats.queries)
+    route_rows.inc(labels, stats.rows)
+    return response
+
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose request and SQL metrics in Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n",
+                    mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    """Time every request and SQL statement and serve them at /metrics."""
+    if app.config.get("SLOW_QUERY_LOG_FILE"):
+        handler = logging.FileHandler(app.config["SLOW_QUERY_LOG_FILE"])
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_log.addHandler(handler)
+
+    # The listeners are global; only add them for the first app
+    if not event.contains(Engine, "after_cursor_execute",
+                          _after_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.register_blueprint(metrics_bp)
@@ -0,0 +1,176 @@
+import heapq
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import text
+
+from background import run_periodically
+from rental_rollup import FILM_COUNTS_QUERY as ROLLUP_FILM_COUNTS_QUERY
+from rental_rollup import rollup
+
+# How often the background thread re-reads the aggregates from the database.
+DEFAULT_RECONCILE_SECONDS = 300
+TOP_N = 5
+
+FILM_COUNTS_QUERY = text("""
+    SELECT f.film_id, f.title, COUNT(r.rental_id) AS rental_count
+    FROM film f
+    LEFT JOIN inventory i ON f.film_id = i.film_id
+    LEFT JOIN rental r ON i.inventory_id = r.inventory_id
+    GROUP BY f.film_id, f.title
+""")
+
+ACTOR_COUNTS_QUERY = text("""
+    SELECT a.actor_id, a.first_name, a.last_name,
+           COUNT(fa.film_id) AS film_count
+    FROM actor a
+    JOIN film_actor fa ON a.actor_id = fa.actor_id
+    GROUP BY a.actor_id, a.first_name, a.last_name
+""")
+
+
+class Leaderboard:
+    """In-memory rental and actor leaderboards for the landing page.
+
+    Counts are seeded from the database, bumped by record_rental() as rentals
+    are made in this process, and periodically replaced by a fresh aggregate
+    so that rentals made by other workers are eventually picked up. Rentals
+    recorded while a fresh aggregate is being read are replayed onto it, as
+    the aggregate may have been read before they were committed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._films = {}
+        self._actors = {}
+        self._top_films = None
+        self._top_actors = None
+        # film_id -> rentals recorded since load() started reading, or None
+        self._recorded_during_load = None
+        self.ready = False
+        self.reconciled_at = None
+        self.pending_updates = 0
+        self.last_drift = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, session):
+        """Replace the in-memory counts with a fresh aggregate."""
+        # The rollup holds the same counts without scanning every rental
+        film_query = (ROLLUP_FILM_COUNTS_QUERY if rollup.is_ready(session)
+                      else FILM_COUNTS_QUERY)
+        with self._lock:
+            self._recorded_during_load = Counter()
+        try:
+            film_rows = session.execute(film_query).mappings().all()
+            actor_rows = session.execute(ACTOR_COUNTS_QUERY).mappings().all()
+        except Exception:
+            with self._lock:
+                self._recorded_during_load = None
+            raise
+
+        films = {row["film_id"]: dict(row) for row in film_rows}
+        actors = {row["actor_id"]: dict(row) for row in actor_rows}
+
+        with self._lock:
+            recorded = self._recorded_during_load
+            self._recorded_during_load = None
+            for film_id, count in recorded.items():
+                if film_id in films:
+                    films[film_id]["rental_count"] += count
+            drift = 0
+            for film_id, film in films.items():
+                old = self._films.get(film_id)
+                if old and old["rental_count"] != film["rental_count"]:
+                    drift += 1
+            self._films = films
+            self._actors = actors
+            self._top_films = None
+            self._top_actors = None
+            self.ready = True
+            self.reconciled_at = time.time()
+            self.pending_updates = sum(recorded.values())
+            self.last_drift = drift
+
+    def record_rental(self, film_id):
+        """Count a rental that was just committed for film_id."""
+        film_id = int(film_id)
+        with self._lock:
+            if self._recorded_during_load is not None:
+                self._recorded_during_load[film_id] += 1
+            film = self._films.get(film_id)
+            if film is None:
+                # Unknown film (or not seeded yet); the next reconcile
+                # will pick it up.
+                return
+            film["rental_count"] += 1
+            self.pending_updates += 1
+            top = self._top_films
+            if top is not None and (
+                len(top) < TOP_N
+                or film_id in {f["film_id"] for f in top}
+                or film["rental_count"] >= top[-1]["rental_count"]
+            ):
+                self._top_films = None
+
+    def top_rented_films(self):
+        """Return the top rented films, or None if not seeded yet."""
+        with self._lock:
+            if not self.ready:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self._top_films is None:
+                rented = (f for f in self._films.values() if f["rental_count"])
+                self._top_films = heapq.nsmallest(
+                    TOP_N, rented,
+                    key=lambda f: (-f["rental_count"], f["film_id"]),
+                )
+            return [dict(f) for f in self._top_films]
+
+    def top_actors(self):
+        """Return the actors with the most films, or None if not seeded."""
+        with self._lock:
+            if not self.ready:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self._top_actors is None:
+                self._top_actors = heapq.nsmallest(
+                    TOP_N, self._actors.values(),
+                    key=lambda a: (-a["film_count"], a["actor_id"]),
+                )
+            return [dict(a) for a in self._top_actors]
+
+    def stats(self):
+        """Return cache counters and staleness for monitoring."""
+        with self._lock:
+            age = None
+            if self.reconciled_at is not None:
+                age = round(time.time() - self.reconciled_at, 3)
+            return {
+                "ready": self.ready,
+                "films": len(self._films),
+                "actors": len(self._actors),
+                "seconds_since_reconcile": age,
+                "pending_updates": self.pending_updates,
+                "last_drift": self.last_drift,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+leaderboard = Leaderboard()
+
+
+def init_app(app, db):
+    """Seed the leaderboard in the background and keep it reconciled."""
+    if not app.config.get("LEADERBOARD_ENABLED", True):
+        return
+    interval = app.config.get(
+        "LEADERBOARD_RECONCILE_SECONDS", DEFAULT_RECONCILE_SECONDS
+    )
+    run_periodically(
+        app, db, "leaderboard-reconcile", interval, leaderboard.load
+    )
@@ -0,0 +1,339 @@
+import datetime
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        bindparam, text)
+from sqlalchemy.exc import DBAPIError
+
+from analytics import analytics
+from availability import allocator, locking
+from background import run_periodically
+from queries import Statement
+from rental_rollup import rollup
+
+DEFAULT_CHUNK_ROWS = 500
+DEFAULT_POLL_SECONDS = 1
+# A running job whose worker hasn't finished a chunk for this long is
+# assumed dead and handed to another worker. Purging is idempotent.
+STALE_JOB_SECONDS = 300
+
+metadata = MetaData()
+
+# Lives next to the Sakila tables so every worker sees the same queue
+purge_jobs = Table(
+    "customer_purge_job", metadata,
+    Column("job_id", Integer, primary_key=True),
+    Column("customer_id", Integer, nullable=False, index=True),
+    Column("status", String(16), nullable=False, index=True),
+    Column("payments_deleted", Integer, nullable=False, default=0),
+    Column("rentals_deleted", Integer, nullable=False, default=0),
+    Column("chunks", Integer, nullable=False, default=0),
+    Column("max_chunk_ms", Integer, nullable=False, default=0),
+    Column("total_chunk_ms", Integer, nullable=False, default=0),
+    Column("error", String(255)),
+    Column("created_at", DateTime, nullable=False),
+    Column("started_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("finished_at", DateTime),
+    schema="sakila",
+)
+
+JOB_COLUMNS = [column.name for column in purge_jobs.columns]
+
+ENQUEUE_JOB = text("""
+    INSERT INTO sakila.customer_purge_job
+        (customer_id, status, payments_deleted, rentals_deleted, chunks,
+         max_chunk_ms, total_chunk_ms, created_at)
+    VALUES (:customer_id, 'queued', 0, 0, 0, 0, 0, :now)
+""")
+
+# A locking read where there are row locks, so it sees a job queued by a
+# concurrent request that held the customer row before this one
+OPEN_JOB = Statement("purge.open_job", """
+    SELECT job_id FROM sakila.customer_purge_job
+    WHERE customer_id = :customer_id
+      AND status IN ('queued', 'running'){for_update}
+""", for_update=" FOR UPDATE")
+
+GET_JOB = text(
+    "SELECT " + ", ".join(JOB_COLUMNS)
+    + " FROM sakila.customer_purge_job WHERE job_id = :job_id"
+)
+
+PENDING_JOBS = text("""
+    SELECT job_id, customer_id FROM sakila.customer_purge_job
+    WHERE status = 'queued'
+       OR (status = 'running' AND updated_at < :stale_before)
+    ORDER BY job_id
+""")
+
+CLAIM_JOB = text("""
+    UPDATE sakila.customer_purge_job
+    SET status = 'running', started_at = :now, updated_at = :now
+    WHERE job_id = :job_id
+      AND (status = 'queued'
+           OR (status = 'running' AND updated_at < :stale_before))
+""")
+
+RECORD_CHUNK = text("""
+    UPDATE sakila.customer_purge_job
+    SET payments_deleted = payments_deleted + :payments,
+        rentals_deleted = rentals_deleted + :rentals,
+        chunks = chunks + 1,
+        max_chunk_ms = CASE WHEN max_chunk_ms > :ms
+                            THEN max_chunk_ms ELSE :ms END,
+        total_chunk_ms = total_chunk_ms + :ms,
+        updated_at = :now
+    WHERE job_id = :job_id
+""")
+
+FINISH_JOB = text("""
+    UPDATE sakila.customer_purge_job
+    SET status = :status, error = :error, finished_at = :now, updated_at = :now
+    WHERE job_id = :job_id
+""")
+
+PAYMENT_CHUNK = text("""
+    SELECT payment_id FROM sakila.payment
+    WHERE customer_id = :customer_id
+    ORDER BY payment_id
+    LIMIT :limit
+""")
+
+DELETE_PAYMENTS = text(
+    "DELETE FROM sakila.payment WHERE payment_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+RENTAL_CHUNK = text("""
+    SELECT rental_id FROM sakila.rental
+    WHERE customer_id = :customer_id
+    ORDER BY rental_id
+    LIMIT :limit
+""")
+
+# Copies out on rentals about to be deleted, which become free again
+OPEN_COPIES = text("""
+    SELECT i.film_id, r.inventory_id
+    FROM sakila.rental r
+    JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+    WHERE r.rental_id IN :ids AND r.return_date IS NULL
+""").bindparams(bindparam("ids", expanding=True))
+
+DELETE_RENTALS = text(
+    "DELETE FROM sakila.rental WHERE rental_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+DELETE_CUSTOMER = text(
+    "DELETE FROM sakila.customer WHERE customer_id = :customer_id"
+)
+
+
+def _now():
+    return datetime.datetime.now().replace(microsecond=0)
+
+
+class CustomerPurger:
+    """Deletes customers' payments, rentals and row in small transactions.
+
+    enqueue() only records a job; the background worker then removes the
+    customer's rows CHUNK_ROWS at a time, committing after every chunk, so
+    no transaction holds locks on payment or rental for long. Each chunk's
+    duration (its lock hold time) is recorded on the job row. The worker
+    creates the job table when it starts; `flask customer-purge
+    create-table` does the same for deployments that run without it. Until
+    the table exists, delete_now() deletes customers in the request instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self.chunk_rows = DEFAULT_CHUNK_ROWS
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.chunks = 0
+        self.max_chunk_ms = 0
+
+    def create_table(self, session):
+        metadata.create_all(session.get_bind())
+        with self._lock:
+            self._table_ready = True
+
+    def has_table(self, session):
+        with self._lock:
+            if self._table_ready:
+                return True
+        # Probe on a separate connection so a missing table doesn't fail
+        # the caller's transaction
+        try:
+            with session.get_bind().connect() as conn:
+                conn.execute(
+                    text(f"SELECT 1 FROM {purge_jobs.fullname} LIMIT 1")
+                )
+        except DBAPIError:
+            return False
+        with self._lock:
+            self._table_ready = True
+        return True
+
+    def enqueue(self, session, customer_id):
+        """
+        Queue a purge of customer_id in the caller's transaction and return
+        its job_id. An unfinished job for the same customer is reused. The
+        caller must have locked the customer's row (by updating it), so
+        concurrent requests for one customer queue a single job.
+        """
+        params = {"customer_id": customer_id}
+        include = locking(session)
+        job_id = OPEN_JOB.execute(session, params, include).scalar()
+        if job_id is not None:
+            return job_id
+        session.execute(ENQUEUE_JOB, {"customer_id": customer_id,
+                                      "now": _now()})
+        return OPEN_JOB.execute(session, params, include).scalar()
+
+    def delete_now(self, session, customer_id):
+        """
+        Delete customer_id's payments, rentals and row in the caller's
+        transaction, as DELETE did before purges were queued. Returns the
+        (film_id, inventory_id) copies the deleted rentals had out, to
+        release() once the caller has committed.
+        """
+        freed = []
+        for select, delete in ((PAYMENT_CHUNK, self._delete_payments),
+                               (RENTAL_CHUNK, self._delete_rentals)):
+            while True:
+                ids = session.execute(select, {
+                    "customer_id": customer_id, "limit": self.chunk_rows,
+                }).scalars().all()
+                if not ids:
+                    break
+                freed.extend(delete(session, ids)[2])
+        session.execute(DELETE_CUSTOMER, {"customer_id": customer_id})
+        return freed
+
+    def job(self, session, job_id):
+        """Return a job's row as a dict, or None."""
+        if not self.has_table(session):
+            return None
+        row = session.execute(GET_JOB, {"job_id": job_id}).mappings().first()
+        return dict(row) if row else None
+
+    def run_pending(self, session):
+        """Claim and run every queued (or abandoned) job."""
+        if not self.has_table(session):
+            self.create_table(session)
+        stale_before = _now() - datetime.timedelta(seconds=STALE_JOB_SECONDS)
+        jobs = session.execute(
+            PENDING_JOBS, {"stale_before": stale_before}
+        ).all()
+        session.commit()
+        for job_id, customer_id in jobs:
+            claimed = session.execute(CLAIM_JOB, {
+                "job_id": job_id, "now": _now(), "stale_before": stale_before,
+            }).rowcount
+            session.commit()
+            if claimed:
+                self.run(session, job_id, customer_id)
+
+    def run(self, session, job_id, customer_id):
+        try:
+            # Payments first: they reference the rentals
+            while self._chunk(session, job_id, PAYMENT_CHUNK, customer_id,
+                              self._delete_payments):
+                pass
+            while self._chunk(session, job_id, RENTAL_CHUNK, customer_id,
+                              self._delete_rentals):
+                pass
+            session.execute(DELETE_CUSTOMER, {"customer_id": customer_id})
+            session.execute(FINISH_JOB, {"job_id": job_id, "status": "done",
+                                         "error": None, "now": _now()})
+            session.commit()
+            with self._lock:
+                self.jobs_done += 1
+        except Exception as e:
+            session.rollback()
+            session.execute(FINISH_JOB, {"job_id": job_id, "status": "failed",
+                                         "error": str(e)[:255], "now": _now()})
+            session.commit()
+            with self._lock:
+                self.jobs_failed += 1
+            raise
+
+    def _chunk(self, session, job_id, select, customer_id, delete):
+        """Delete one chunk in its own transaction; False when none left."""
+        started = time.perf_counter()
+        ids = session.execute(select, {
+            "customer_id": customer_id, "limit": self.chunk_rows,
+        }).scalars().all()
+        if not ids:
+            session.rollback()
+            return False
+        payments, rentals, freed = delete(session, ids)
+        session.commit()
+        ms = round((time.perf_counter() - started) * 1000)
+        for film_id, inventory_id in freed:
+            allocator.release(film_id, inventory_id)
+
+        session.execute(RECORD_CHUNK, {"job_id": job_id, "payments": payments,
+                                       "rentals": rentals, "ms": ms,
+                                       "now": _now()})
+        session.commit()
+        with self._lock:
+            self.chunks += 1
+            self.max_chunk_ms = max(self.max_chunk_ms, ms)
+        return True
+
+    def _delete_payments(self, session, ids):
+        session.execute(DELETE_PAYMENTS, {"ids": ids})
+        return len(ids), 0, ()
+
+    def _delete_rentals(self, session, ids):
+        freed = session.execute(OPEN_COPIES, {"ids": ids}).all()
+        rollup.forget_rentals(session, ids)
+        analytics.forget_rentals(session, ids)
+        session.execute(DELETE_RENTALS, {"ids": ids})
+        return 0, len(ids), freed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chunk_rows": self.chunk_rows,
+                "jobs_done": self.jobs_done,
+                "jobs_failed": self.jobs_failed,
+                "chunks": self.chunks,
+                "max_chunk_ms": self.max_chunk_ms,
+            }
+
+
+purger = CustomerPurger()
+
+
+def init_app(app, db):
+    """
+    Register the `flask customer-purge create-table` command and start the
+    background worker that creates the job table and runs queued customer
+    purges.
+    """
+    purger.chunk_rows = app.config.get(
+        "CUSTOMER_PURGE_CHUNK_ROWS", DEFAULT_CHUNK_ROWS
+    )
+
+    cli = AppGroup("customer-purge", help="Manage customer purge jobs.")
+
+    @cli.command("create-table")
+    def create_table_command():
+        """Create the customer purge job table if it doesn't exist."""
+        purger.create_table(db.session)
+        click.echo(f"{purge_jobs.fullname} is ready")
+
+    app.cli.add_command(cli)
+
+    if not app.config.get("CUSTOMER_PURGE_WORKER_ENABLED", True):
+        return
+    interval = app.config.get(
+        "CUSTOMER_PURGE_POLL_SECONDS", DEFAULT_POLL_SECONDS
+    )
+    run_periodically(app, db, "customer-purge", interval, purger.run_pending)
@@ -0,0 +1,184 @@
+import re
+import threading
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import make_url
+
+DEFAULT_STATEMENT_CACHE_SIZE = 256
+# Batch sizes a MultiRowInsert keeps compiled
+MAX_BATCH_VARIANTS = 16
+
+_BIND = re.compile(r"(?<!:):(\w+)")
+
+
+class Statement:
+    """
+    A named SQL statement declared once at import.
+
+    sql may contain {name} placeholders for optional clauses; a clause is
+    included when its parameter is present (not None) in the params of an
+    execution, or when it is named in include. Each combination of clauses
+    is turned into a text() object the first time it is used and reused
+    afterwards, so requests neither concatenate SQL nor parse bind
+    parameters, and every variant keeps the same SQL string, which is what
+    SQLAlchemy's compiled cache and the driver's prepared statement cache
+    are keyed on.
+
+        CUSTOMERS = Statement("customers.search", '''
+            SELECT * FROM customer WHERE 1=1{first_name}
+        ''', first_name=" AND first_name LIKE :first_name")
+        CUSTOMERS.execute(db.session, {"first_name": "A%"})
+    """
+
+    def __init__(self, name, sql, expanding=(), **clauses):
+        self.name = name
+        self.sql = sql
+        self.expanding = tuple(expanding)
+        self.clauses = clauses
+        self._variants = {}
+        registry.add(self)
+
+    def variant(self, params=None, include=()):
+        """The text() object for the clauses present in params or include."""
+        params = params or {}
+        key = tuple(name for name in self.clauses
+                    if name in include or params.get(name) is not None)
+        statement = self._variants.get(key)
+        if statement is None:
+            statement = self._variants[key] = self._compile(key)
+        return statement
+
+    def _compile(self, key):
+        sql = self.sql.format_map({
+            name: clause if name in key else ""
+            for name, clause in self.clauses.items()
+        })
+        # Instrumentation labels statements by this name instead of SQL
+        label = self.name
+        if self.clauses:
+            label += "[" + ",".join(key) + "]"
+        statement = text(sql).execution_options(statement_name=label)
+        if self.expanding:
+            statement = statement.bindparams(*(
+                bindparam(name, expanding=True) for name in self.expanding
+            ))
+        return statement
+
+    def execute(self, session, params=None, include=(), **kwargs):
+        """Run the matching variant on session and count the execution."""
+        registry.count(self.name)
+        return session.execute(self.variant(params, include), params,
+                               **kwargs)
+
+
+class MultiRowInsert(Statement):
+    """
+    An INSERT that writes a whole batch of rows in one statement. sql has a
+    {rows} placeholder for the VALUES list and row is the tuple for one
+    row; each batch size is compiled once (up to MAX_BATCH_VARIANTS sizes,
+    so the common full batch is always cached) with the binds of row i
+    suffixed _i.
+
+        ADDRESSES = MultiRowInsert("addresses.insert",
+            "INSERT INTO address (address, phone) VALUES {rows}",
+            "(:address, :phone)")
+        ADDRESSES.execute(db.session, [{"address": ..., "phone": ...}])
+    """
+
+    def __init__(self, name, sql, row):
+        super().__init__(name, sql)
+        self.row = row
+        self.columns = _BIND.findall(row)
+
+    def batch(self, count):
+        """The text() object inserting count rows."""
+        statement = self._variants.get(count)
+        if statement is None:
+            # Literal text and bind names alternate in the split row
+            parts = _BIND.split(self.row)
+            rows = ", ".join(
+                "".join(part if n % 2 == 0 else f":{part}_{i}"
+                        for n, part in enumerate(parts))
+                for i in range(count)
+            )
+            statement = text(self.sql.format(rows=rows)).execution_options(
+                statement_name=self.name
+            )
+            if len(self._variants) < MAX_BATCH_VARIANTS:
+                self._variants[count] = statement
+        return statement
+
+    def execute(self, session, rows, **kwargs):
+        """Insert rows (mappings with the row's bind names) at once."""
+        registry.count(self.name)
+        params = {f"{column}_{i}": row[column]
+                  for i, row in enumerate(rows) for column in self.columns}
+        return session.execute(self.batch(len(rows)), params, **kwargs)
+
+
+class QueryRegistry:
+    """Every declared Statement, with per-statement execution counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.executions = {}
+        self.prepared = None
+
+    def add(self, statement):
+        with self._lock:
+            if statement.name in self.statements:
+                raise ValueError(f"duplicate statement name {statement.name}")
+            self.statements[statement.name] = statement
+            self.executions[statement.name] = 0
+
+    def count(self, name):
+        with self._lock:
+            self.executions[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prepared_statements": self.prepared,
+                "statements": {
+                    name: {
+                        "executions": self.executions[name],
+                        "variants": len(statement._variants),
+                    }
+                    for name, statement in sorted(self.statements.items())
+                },
+            }
+
+
+registry = QueryRegistry()
+
+
+def prepared_statement_options(uri, cache_size):
+    """
+    Driver connect arguments that keep statements prepared per connection,
+    and a description of what the driver does. sqlite3 keeps a per
+    connection cache of prepared statements keyed by SQL string; psycopg
+    prepares a statement on the server once it has run prepare_threshold
+    times. PyMySQL and mysqlclient have no server-side prepared statements,
+    so on MySQL only the client-side compiled cache applies.
+    """
+    url = make_url(uri)
+    backend, driver = url.get_backend_name(), url.get_driver_name()
+    if backend == "sqlite":
+        return {"cached_statements": cache_size}, "sqlite statement cache"
+    if backend == "postgresql" and driver == "psycopg":
+        return {"prepare_threshold": 1}, "server-side (psycopg)"
+    return {}, f"none ({driver} has no server-side prepared statements)"
+
+
+def init_app(app):
+    """Set the driver's prepared statement options; call before db.init_app."""
+    connect_args, registry.prepared = prepared_statement_options(
+        app.config["SQLALCHEMY_DATABASE_URI"],
+        app.config.get("STATEMENT_CACHE_SIZE", DEFAULT_STATEMENT_CACHE_SIZE),
+    )
+    if connect_args:
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        options["connect_args"] = {**connect_args,
+                                   **options.get("connect_args", {})}
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
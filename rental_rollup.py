@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import Counter
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import (Column, Index, Integer, MetaData, Table, bindparam,
+                        text)
+
+import rollup_status
+from queries import Statement
+
+metadata = MetaData()
+
+film_rental_stats = Table(
+    "film_rental_stats", metadata,
+    Column("film_id", Integer, primary_key=True, autoincrement=False),
+    Column("rental_count", Integer, nullable=False, default=0),
+    schema="sakila",
+)
+
+actor_film_rental_stats = Table(
+    "actor_film_rental_stats", metadata,
+    Column("actor_id", Integer, primary_key=True, autoincrement=False),
+    Column("film_id", Integer, primary_key=True, autoincrement=False),
+    Column("rental_count", Integer, nullable=False, default=0),
+    Index("idx_actor_film_rental_count", "actor_id", "rental_count"),
+    Index("idx_actor_film_rental_film", "film_id"),
+    schema="sakila",
+)
+
+FILM_COUNTS_SQL = """
+    SELECT f.film_id, COUNT(r.rental_id) AS rental_count
+    FROM sakila.film f
+    LEFT JOIN sakila.inventory i ON f.film_id = i.film_id
+    LEFT JOIN sakila.rental r ON i.inventory_id = r.inventory_id
+    GROUP BY f.film_id
+"""
+
+ACTOR_FILM_COUNTS_SQL = """
+    SELECT fa.actor_id, fa.film_id, COUNT(r.rental_id) AS rental_count
+    FROM sakila.film_actor fa
+    LEFT JOIN sakila.inventory i ON fa.film_id = i.film_id
+    LEFT JOIN sakila.rental r ON i.inventory_id = r.inventory_id
+    GROUP BY fa.actor_id, fa.film_id
+"""
+
+BUILD_STATEMENTS = [
+    text("DELETE FROM sakila.film_rental_stats"),
+    text("DELETE FROM sakila.actor_film_rental_stats"),
+    text("INSERT INTO sakila.film_rental_stats (film_id, rental_count)"
+         + FILM_COUNTS_SQL),
+    text("INSERT INTO sakila.actor_film_rental_stats"
+         " (actor_id, film_id, rental_count)" + ACTOR_FILM_COUNTS_SQL),
+]
+
+INCREMENT_FILM = text("""
+    UPDATE sakila.film_rental_stats SET rental_count = rental_count + :amount
+    WHERE film_id = :film_id
+""")
+
+INCREMENT_ACTOR_FILM = text("""
+    UPDATE sakila.actor_film_rental_stats
+    SET rental_count = rental_count + :amount
+    WHERE film_id = :film_id
+""")
+
+RENTAL_FILMS = text("""
+    SELECT i.film_id, COUNT(*) AS rentals
+    FROM sakila.rental r
+    JOIN sakila.inventory i ON r.inventory_id = i.inventory_id
+    WHERE r.rental_id IN :rental_ids
+    GROUP BY i.film_id
+""").bindparams(bindparam("rental_ids", expanding=True))
+
+# Indexed replacement for the rental aggregate in films.actor_details
+ACTOR_TOP_FILMS_QUERY = Statement("rollup.actor_top_films", """
+    SELECT f.film_id, f.title, s.rental_count
+    FROM sakila.actor_film_rental_stats s
+    JOIN sakila.film f ON f.film_id = s.film_id
+    WHERE s.actor_id = :actor_id AND s.rental_count > 0
+    ORDER BY s.rental_count DESC
+    LIMIT 5
+""")
+
+FILM_COUNTS_QUERY = text("""
+    SELECT f.film_id, f.title, s.rental_count
+    FROM sakila.film f
+    JOIN sakila.film_rental_stats s ON f.film_id = s.film_id
+""")
+
+
+class RentalRollup:
+    """Precomputed rental counts per film and per actor-film pair.
+
+    The tables are filled by build() and then kept current by record() and
+    forget_rentals(), which run inside the transactions that insert or
+    delete rentals, so every worker sees the same counts. Until build() has
+    marked the rollup built (see rollup_status), is_ready() is False,
+    nothing is recorded and callers fall back to the live aggregate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status = rollup_status.RollupStatus("rental_rollup")
+        self.increments = 0
+
+    def is_ready(self, session):
+        """Whether the rollup has been built; see RollupStatus.is_ready()."""
+        return self.status.is_ready(session)
+
+    def record(self, session, film_ids):
+        """Count new rentals of film_ids in the caller's transaction."""
+        if not self.status.built(session):
+            return
+        # Fixed order so concurrent rentals lock the rows the same way
+        counts = sorted(Counter(int(film_id) for film_id in film_ids).items())
+        params = [{"film_id": film_id, "amount": amount}
+                  for film_id, amount in counts]
+        if not params:
+            return
+        session.execute(INCREMENT_FILM, params)
+        session.execute(INCREMENT_ACTOR_FILM, params)
+        with self._lock:
+            self.increments += len(params)
+
+    def forget_rentals(self, session, rental_ids):
+        """
+        Subtract rental_ids, which the caller is about to delete in the same
+        transaction.
+        """
+        if not rental_ids or not self.status.built(session):
+            return
+        rows = sorted(session.execute(
+            RENTAL_FILMS, {"rental_ids": list(rental_ids)}
+        ).all())
+        params = [{"film_id": film_id, "amount": -rentals}
+                  for film_id, rentals in rows]
+        if params:
+            session.execute(INCREMENT_FILM, params)
+            session.execute(INCREMENT_ACTOR_FILM, params)
+
+    def build(self, session):
+        """(Re)create the rollup tables from a full aggregate and commit."""
+        metadata.create_all(session.get_bind())
+        rollup_status.create_table(session)
+        for statement in BUILD_STATEMENTS:
+            session.execute(statement)
+        self.status.mark_built(session)
+        session.commit()
+        self.status.set_built()
+        return {
+            table.name: session.execute(
+                text(f"SELECT COUNT(*) FROM {table.fullname}")
+            ).scalar()
+            for table in metadata.sorted_tables
+        }
+
+    def check(self, session):
+        """
+        Compare the rollup against a fresh aggregate. Returns a dict of
+        table name to a list of (key, rollup value, actual value) for every
+        row that differs, missing rows included.
+        """
+        comparisons = [
+            (film_rental_stats, FILM_COUNTS_SQL, 1),
+            (actor_film_rental_stats, ACTOR_FILM_COUNTS_SQL, 2),
+        ]
+        mismatches = {}
+        for table, actual_sql, key_columns in comparisons:
+            columns = ", ".join(column.name for column in table.columns)
+            stored = _by_key(session.execute(
+                text(f"SELECT {columns} FROM {table.fullname}")
+            ), key_columns)
+            actual = _by_key(session.execute(text(actual_sql)), key_columns)
+            mismatches[table.name] = [
+                (key, stored.get(key), actual.get(key))
+                for key in sorted(set(stored) | set(actual))
+                if stored.get(key) != actual.get(key)
+            ]
+        return mismatches
+
+    def stats(self):
+        with self._lock:
+            return {"ready": self.status.ready,
+                    "increments": self.increments}
+
+
+def _by_key(rows, key_columns):
+    return {tuple(row[:key_columns]): row[key_columns] for row in rows}
+
+
+rollup = RentalRollup()
+
+
+def init_app(app, db):
+    """Register the `flask rental-rollup build|check` commands."""
+    cli = AppGroup("rental-rollup", help="Manage the rental count rollup.")
+
+    @cli.command("build")
+    def build_command():
+        """Rebuild the rollup tables from the rental history."""
+        started = time.perf_counter()
+        counts = rollup.build(db.session)
+        for name, rows in counts.items():
+            click.echo(f"{name}: {rows} rows")
+        click.echo(f"built in {time.perf_counter() - started:.2f}s")
+
+    @cli.command("check")
+    @click.option("--limit", default=20, help="Mismatches to print per table.")
+    def check_command(limit):
+        """Compare the rollup with a fresh aggregate; exit 1 on drift."""
+        mismatches = rollup.check(db.session)
+        for name, rows in mismatches.items():
+            click.echo(f"{name}: {len(rows)} mismatched rows")
+            for key, stored, actual in rows[:limit]:
+                click.echo(f"  {key}: rollup={stored} actual={actual}")
+        if any(mismatches.values()):
+            raise SystemExit(1)
+
+    app.cli.add_command(cli)
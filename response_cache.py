@@ -0,0 +1,166 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+
+DEFAULT_MAX_ENTRIES = 2048
+# How long a cached body is served before its version query is re-run
+DEFAULT_REVALIDATE_SECONDS = 5
+
+
+class CacheEntry:
+    __slots__ = ("body", "etag", "last_modified", "version", "checked_at",
+                 "created_at", "film_ids")
+
+    def __init__(self, body, etag, last_modified, version, film_ids=()):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.version = version
+        self.checked_at = self.created_at = time.monotonic()
+        self.film_ids = frozenset(film_ids)
+
+
+class ResponseCache:
+    """Bounded LRU of serialized response bodies with their validators.
+
+    Entries are checked against a cheap version query (the rows'
+    last_update values) at most every REVALIDATE seconds and rebuilt when it
+    changes. Entries can also carry the film ids whose rentals affect them,
+    so a rental drops them immediately.
+    """
+
+    def __init__(self, name, max_entries=DEFAULT_MAX_ENTRIES):
+        self.name = name
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_film(self, film_id):
+        """Drop entries whose content depends on rentals of film_id."""
+        film_id = int(film_id)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if film_id in entry.film_ids]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "invalidations": self.invalidations,
+            }
+
+
+film_cache = ResponseCache("film")
+actor_cache = ResponseCache("actor")
+
+
+def _as_datetime(value):
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value
+
+
+def _newest(version):
+    stamps = [_as_datetime(v) for v in version
+              if isinstance(v, (datetime.datetime, str))]
+    return max(stamps) if stamps else None
+
+
+def cached_response(cache, key, load_version, render, max_age,
+                    max_stale=None, load_film_ids=None):
+    """
+    Serve a GET response from cache with ETag/Last-Modified validators.
+
+    load_version() returns a tuple of last_update values for the rows the
+    response is built from, or None if they don't exist. render() builds the
+    response; only 200s are cached. load_film_ids(), if given, returns the
+    films whose rentals change the response, and max_stale bounds how long
+    such an entry lives when those rentals happen in another worker.
+    Conditional requests are answered with 304 by make_conditional().
+    """
+    revalidate = current_app.config.get(
+        "RESPONSE_CACHE_REVALIDATE_SECONDS", DEFAULT_REVALIDATE_SECONDS
+    )
+    now = time.monotonic()
+    entry = cache.get(key)
+    previous = entry
+    version = None
+    if entry is not None and max_stale is not None \
+            and now - entry.created_at > max_stale:
+        entry = None
+    if entry is not None and now - entry.checked_at > revalidate:
+        cache.count("revalidations")
+        version = load_version()
+        if version == entry.version:
+            entry.checked_at = now
+        else:
+            entry = None
+
+    cache.count("hits" if entry is not None else "misses")
+    if entry is None:
+        if version is None:
+            version = load_version()
+        response = current_app.make_response(render())
+        if version is None or response.status_code != 200:
+            cache.invalidate(key)
+            return response
+        body = response.get_data()
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        if previous is not None and previous.etag == etag:
+            last_modified = previous.last_modified
+        elif load_film_ids is not None:
+            # Rentals change the body without touching last_update
+            last_modified = datetime.datetime.now(datetime.timezone.utc)
+        else:
+            last_modified = _newest(version)
+        film_ids = load_film_ids() if load_film_ids is not None else ()
+        entry = CacheEntry(body, etag, last_modified, version, film_ids)
+        cache.put(key, entry)
+
+    response = current_app.response_class(
+        entry.body, mimetype="application/json"
+    )
+    response.set_etag(entry.etag)
+    if entry.last_modified is not None:
+        response.last_modified = entry.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
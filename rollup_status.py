@@ -0,0 +1,126 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, text
+
+from background import run_periodically
+
+# How often workers look for the status table and the marks of rollups
+# that haven't been built, and reads look for a missing mark
+RECHECK_SECONDS = 30
+
+metadata = MetaData()
+
+# One row per built rollup, written by its build command in the transaction
+# that fills it
+status_table = Table(
+    "rollup_status", metadata,
+    Column("name", String(64), primary_key=True),
+    Column("built_at", DateTime, nullable=False),
+    schema="sakila",
+)
+
+BUILT_QUERY = text(
+    "SELECT built_at FROM sakila.rollup_status WHERE name = :name"
+)
+
+CLEAR_BUILT = text("DELETE FROM sakila.rollup_status WHERE name = :name")
+
+MARK_BUILT = text("""
+    INSERT INTO sakila.rollup_status (name, built_at) VALUES (:name, :now)
+""")
+
+_lock = threading.Lock()
+_table_ready = False
+statuses = []
+
+
+def create_table(session):
+    """Create the status table if it doesn't exist."""
+    global _table_ready
+    metadata.create_all(session.get_bind())
+    with _lock:
+        _table_ready = True
+
+
+class RollupStatus:
+    """Whether the rollup called name has been built.
+
+    Writes ask built(), which reads the rollup's mark in the caller's
+    transaction, on its connection, until it is found, so a rollup built
+    by another process is kept current from the next write on. Reads ask
+    is_ready(), which remembers a negative answer for RECHECK_SECONDS. Both
+    answer False without a query until this worker has seen the status
+    table, which refresh() creates when the worker starts.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._built = False
+        self._checked_at = None
+        statuses.append(self)
+
+    @property
+    def ready(self):
+        """The last known answer, without a query."""
+        with self._lock:
+            return self._built
+
+    def built(self, session):
+        """Whether the rollup is built, as of the caller's transaction."""
+        with _lock:
+            table_ready = _table_ready
+        with self._lock:
+            if self._built:
+                return True
+        if not table_ready:
+            return False
+        built = session.execute(
+            BUILT_QUERY, {"name": self.name}
+        ).first() is not None
+        if built:
+            with self._lock:
+                self._built = True
+        return built
+
+    def is_ready(self, session):
+        """Like built(), but a negative answer is remembered for a while."""
+        now = time.monotonic()
+        with self._lock:
+            if self._built:
+                return True
+            if self._checked_at is not None \
+                    and now - self._checked_at < RECHECK_SECONDS:
+                return False
+            self._checked_at = now
+        return self.built(session)
+
+    def mark_built(self, session):
+        """
+        Mark the rollup built in the caller's transaction, which fills it.
+        Call set_built() once it has committed.
+        """
+        params = {"name": self.name}
+        session.execute(CLEAR_BUILT, params)
+        session.execute(MARK_BUILT, {**params, "now": datetime.datetime.now()})
+
+    def set_built(self):
+        with self._lock:
+            self._built = True
+
+
+def refresh(session):
+    """Create the status table if needed and look for new marks."""
+    with _lock:
+        table_ready = _table_ready
+    if not table_ready:
+        create_table(session)
+    for status in statuses:
+        status.built(session)
+
+
+def init_app(app, db):
+    """Create the status table and pick up built rollups in the background."""
+    run_periodically(app, db, "rollup-status", RECHECK_SECONDS, refresh)
@@ -0,0 +1,291 @@
+import functools
+import itertools
+import re
+import threading
+import time
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.elements import TextClause
+
+from background import run_periodically
+
+DEFAULT_HEALTH_CHECK_SECONDS = 5
+DEFAULT_MAX_LAG_SECONDS = 30
+DEFAULT_READ_YOUR_WRITES_SECONDS = 5
+
+READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+STICKY_COOKIE = "sakila_primary_until"
+
+_LOCKING_READ = re.compile(r"\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\b",
+                           re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def _is_read_sql(sql):
+    """Whether sql only reads (a plain SELECT, not a locking one)."""
+    head = sql.lstrip()[:6].upper()
+    return head in ("SELECT", "WITH") and not _LOCKING_READ.search(sql)
+
+
+def is_read(clause):
+    """Whether a statement can run on a replica."""
+    if clause is None:
+        return False
+    if isinstance(clause, TextClause):
+        return _is_read_sql(clause.text)
+    return getattr(clause, "is_select", False)
+
+
+class RoutingSession(Session):
+    """
+    The db.session class: statements of a read request go to the replica
+    the router picked for it, everything else to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and mapper is None:
+            engine = router.engine_for(self, clause)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+    def execute(self, statement, *args, **kwargs):
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except DBAPIError as e:
+            if not (e.connection_invalidated and router.fail_over(self)):
+                raise
+        # The request's replica went away; run the read once more on the
+        # primary
+        return super().execute(statement, *args, **kwargs)
+
+
+class ReplicaRouter:
+    """Picks a healthy replica per read request and tracks replica health.
+
+    Replicas are Flask-SQLAlchemy binds named replica-1, replica-2, ...
+    with the same engine options as the primary. A GET (or HEAD/OPTIONS)
+    request is given one replica, round robin among the healthy ones, and
+    its SELECTs run there; anything else it executes, and every statement
+    of other requests, runs on the primary. Once a request has written, the
+    rest of its reads stay on the primary too. A client that made a write
+    request is sent a cookie that keeps its reads on the primary for
+    READ_YOUR_WRITES_SECONDS, so it sees its own writes despite replication
+    lag. Replicas that fail a periodic health check, lag too far behind or
+    drop a connection are skipped until they pass a check again; with none
+    healthy, reads go to the primary. A read that fails because its
+    replica dropped the connection is retried once on the primary, where
+    the rest of its request then reads too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._engine_keys = {}
+        self.replicas = {}
+        self.sticky_seconds = DEFAULT_READ_YOUR_WRITES_SECONDS
+        self.max_lag_seconds = DEFAULT_MAX_LAG_SECONDS
+        self.replica_requests = 0
+        self.primary_requests = {"sticky": 0, "no_healthy_replica": 0}
+        self.failovers = 0
+        self.retried_reads = 0
+
+    def configure(self, keys, sticky_seconds, max_lag_seconds):
+        with self._lock:
+            self.replicas = {key: {
+                "healthy": True,
+                "requests": 0,
+                "checked_at": None,
+                "lag_seconds": None,
+                "error": None,
+            } for key in keys}
+            self.sticky_seconds = sticky_seconds
+            self.max_lag_seconds = max_lag_seconds
+
+    def choose(self):
+        """The bind key of the replica for this read request, or None."""
+        sticky_until = request.cookies.get(STICKY_COOKIE)
+        with self._lock:
+            if sticky_until and _is_future(sticky_until):
+                self.primary_requests["sticky"] += 1
+                return None
+            healthy = [key for key, state in self.replicas.items()
+                       if state["healthy"]]
+            if not healthy:
+                self.primary_requests["no_healthy_replica"] += 1
+                return None
+            key = healthy[next(self._turn) % len(healthy)]
+            self.replicas[key]["requests"] += 1
+            self.replica_requests += 1
+            return key
+
+    def engine_for(self, session, clause):
+        """The replica engine for clause, or None for the primary."""
+        if not has_app_context():
+            return None
+        key = g.get("read_replica")
+        if key is None or session.info.get("wrote"):
+            return None
+        if not is_read(clause):
+            # Later reads in this session must see what it wrote
+            if clause is not None:
+                session.info["wrote"] = True
+            return None
+        engine = session._db.engines[key]
+        self._engine_keys.setdefault(engine, key)
+        return engine
+
+    def mark_down(self, key, error):
+        with self._lock:
+            state = self.replicas[key]
+            if state["healthy"]:
+                self.failovers += 1
+            state["healthy"] = False
+            state["error"] = str(error)
+
+    def fail_over(self, session):
+        """
+        Move this request's reads to the primary after its replica dropped
+        the connection. Returns False if it wasn't reading from a replica.
+        """
+        if not has_app_context() or g.get("read_replica") is None:
+            return False
+        g.read_replica = None
+        # The session's transaction was on the lost connection
+        session.rollback()
+        with self._lock:
+            self.retried_reads += 1
+        return True
+
+    def _disconnected(self, context):
+        """handle_error listener: stop routing to a replica that went away."""
+        key = self._engine_keys.get(context.engine)
+        if key is not None and context.is_disconnect:
+            self.mark_down(key, context.original_exception)
+
+    def check(self, engines):
+        """Health-check every replica: connect, SELECT 1, replication lag."""
+        for key in list(self.replicas):
+            self._engine_keys.setdefault(engines[key], key)
+            lag = None
+            try:
+                with engines[key].connect() as conn:
+                    conn.exec_driver_sql("SELECT 1")
+                    lag = replication_lag(conn)
+                if lag is not None and lag > self.max_lag_seconds:
+                    raise RuntimeError(f"replication lag {lag}s")
+            except Exception as e:
+                self.mark_down(key, e)
+                with self._lock:
+                    self.replicas[key]["checked_at"] = time.time()
+                    self.replicas[key]["lag_seconds"] = lag
+                continue
+            with self._lock:
+                self.replicas[key].update(healthy=True, error=None,
+                                          checked_at=time.time(),
+                                          lag_seconds=lag)
+
+    def stats(self):
+        """Return replica health and how read requests were routed."""
+        with self._lock:
+            return {
+                "replicas": {key: dict(state)
+                             for key, state in self.replicas.items()},
+                "replica_requests": self.replica_requests,
+                "primary_requests": dict(self.primary_requests),
+                "failovers": self.failovers,
+                "retried_reads": self.retried_reads,
+                "read_your_writes_seconds": self.sticky_seconds,
+            }
+
+
+router = ReplicaRouter()
+
+
+def _is_future(timestamp):
+    try:
+        return float(timestamp) > time.time()
+    except ValueError:
+        return False
+
+
+def replication_lag(conn):
+    """
+    Seconds a MySQL replica is behind its source, or None where that isn't
+    known (other databases, or a server that isn't a replica). Raises if
+    the replica's replication threads have stopped.
+    """
+    if conn.dialect.name != "mysql":
+        return None
+    # SHOW SLAVE STATUS before MySQL 8.0.22; neither is allowed without the
+    # REPLICATION CLIENT privilege
+    for sql, column in (("SHOW REPLICA STATUS", "Seconds_Behind_Source"),
+                        ("SHOW SLAVE STATUS", "Seconds_Behind_Master")):
+        try:
+            row = conn.exec_driver_sql(sql).mappings().first()
+            break
+        except Exception:
+            continue
+    else:
+        return None
+    if row is None:
+        return None
+    if row[column] is None:
+        raise RuntimeError("replication is not running")
+    return row[column]
+
+
+def _route_request():
+    if request.method in READ_METHODS and router.replicas:
+        g.read_replica = router.choose()
+
+
+def _remember_write(response):
+    seconds = router.sticky_seconds
+    if request.method not in READ_METHODS and router.replicas and seconds:
+        response.set_cookie(STICKY_COOKIE, str(time.time() + seconds),
+                            max_age=seconds, httponly=True, samesite="Lax")
+    return response
+
+
+def init_app(app, db):
+    """
+    Add REPLICA_DATABASE_URIS as binds and route reads to them; call after
+    queries.init_app and before db.init_app, which creates the engines. db
+    must use RoutingSession as its session class (see extensions.py).
+    """
+    uris = app.config.get("REPLICA_DATABASE_URIS") or []
+    if not uris:
+        return
+    # Flask-SQLAlchemy only applies SQLALCHEMY_ENGINE_OPTIONS to the
+    # primary; give the replicas the same pool settings
+    options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    keys = []
+    for number, uri in enumerate(uris, 1):
+        key = f"replica-{number}"
+        binds[key] = {**options, "url": uri}
+        keys.append(key)
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    router.configure(
+        keys,
+        app.config.get("READ_YOUR_WRITES_SECONDS",
+                       DEFAULT_READ_YOUR_WRITES_SECONDS),
+        app.config.get("REPLICA_MAX_LAG_SECONDS", DEFAULT_MAX_LAG_SECONDS),
+    )
+    # The listener is global; only add it for the first app
+    if not event.contains(Engine, "handle_error", router._disconnected):
+        event.listen(Engine, "handle_error", router._disconnected)
+    app.before_request(_route_request)
+    app.after_request(_remember_write)
+
+    interval = app.config.get("REPLICA_HEALTH_CHECK_SECONDS",
+                              DEFAULT_HEALTH_CHECK_SECONDS)
+    run_periodically(app, db, "replica-health", interval,
+                     lambda session: router.check(db.engines))
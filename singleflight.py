@@ -0,0 +1,134 @@
+import threading
+import time
+
+from flask import current_app, request
+
+from instrumentation import current_request_stats
+
+DEFAULT_TIMEOUT_SECONDS = 5
+
+
+class Flight:
+    """One execution in progress, and what its waiters receive."""
+
+    __slots__ = ("done", "started", "result", "error", "statements",
+                 "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.started = time.monotonic()
+        self.result = None
+        self.error = None
+        self.statements = 0
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs identical concurrent calls once and hands everyone the result.
+
+    The first caller for a key executes; callers arriving with the same key
+    while it runs wait for it and get its result (or its exception) instead
+    of executing themselves. A waiter gives up after the timeout and
+    executes on its own, and a flight older than the timeout is not joined,
+    so one stuck execution can't hold a key hostage. Counters report how
+    many executions, and SQL statements, the waiters were spared.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.statements_saved = 0
+        self.timeouts = 0
+        self.max_waiters = 0
+
+    def do(self, key, func, timeout=DEFAULT_TIMEOUT_SECONDS):
+        """Return func(), shared with concurrent calls for the same key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and \
+                    time.monotonic() - flight.started > timeout:
+                flight = None
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                self.executions += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.max_waiters = max(self.max_waiters, flight.waiters)
+                leader = False
+
+        if leader:
+            return self._lead(key, flight, func)
+
+        if not flight.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+                self.executions += 1
+            return func()
+        with self._lock:
+            self.coalesced += 1
+            self.statements_saved += flight.statements
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _lead(self, key, flight, func):
+        stats = current_request_stats()
+        before = stats.queries if stats is not None else 0
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            if stats is not None:
+                flight.statements = stats.queries - before
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        """Return execution, coalescing and timeout counters."""
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "statements_saved": self.statements_saved,
+                "timeouts": self.timeouts,
+                "max_waiters": self.max_waiters,
+            }
+
+
+film_flight = SingleFlight("film")
+actor_flight = SingleFlight("actor")
+search_flight = SingleFlight("films")
+
+
+def coalesced_response(flight, key, view):
+    """
+    Serve view() for a GET, running it once for identical concurrent
+    requests. key identifies the route's normalized parameters; the
+    request's conditional headers are added to it, since they change the
+    response. Each request gets its own copy of the shared response, so
+    after_request hooks (compression, cookies) still apply per request.
+    """
+    app = current_app._get_current_object()
+    if not app.config.get("SINGLE_FLIGHT_ENABLED", True):
+        return view()
+    key = (key, request.headers.get("If-None-Match"),
+           request.headers.get("If-Modified-Since"))
+    timeout = app.config.get("SINGLE_FLIGHT_TIMEOUT_SECONDS",
+                             DEFAULT_TIMEOUT_SECONDS)
+
+    def run():
+        response = app.make_response(view())
+        return response.get_data(), response.status, list(response.headers)
+
+    body, status, headers = flight.do(key, run, timeout)
+    return app.response_class(body, status=status, headers=headers)
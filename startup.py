@@ -0,0 +1,198 @@
+import threading
+import time
+
+from flask import Blueprint, current_app, jsonify
+
+import background
+from customer_search import customer_index
+from extensions import db
+from film_search import search_index
+from leaderboard import leaderboard
+from rental_rollup import rollup
+from routing import router
+
+DEFAULT_WARMUP_CONNECTIONS = 4
+DEFAULT_WARMUP_TIMEOUT_SECONDS = 30
+DEFAULT_WARMUP_PATHS = ["/", "/film/1", "/actor/1", "/films?film=a",
+                        "/api/customers/"]
+WARMUP_RETRY_SECONDS = 1
+
+startup_bp = Blueprint("startup", __name__)
+
+
+class StartupState:
+    """Startup timings of this worker process and whether it is warm."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = False
+        self.ready = False
+        self.timings = {}
+        self.warnings = []
+        self.error = None
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.timings[name] = round(seconds, 4)
+
+    def status(self):
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "started": self.started,
+                "timings": dict(self.timings),
+                "warnings": list(self.warnings),
+                "error": self.error,
+            }
+
+
+state = StartupState()
+
+
+def _fill_pool(app, engine):
+    size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    wanted = min(app.config.get("WARMUP_CONNECTIONS",
+                                DEFAULT_WARMUP_CONNECTIONS), size)
+    connections = []
+    try:
+        for _ in range(wanted):
+            connection = engine.connect()
+            connection.exec_driver_sql("SELECT 1")
+            connections.append(connection)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def _open_connections(app):
+    """Fill the pools so the first requests don't pay for connecting."""
+    _fill_pool(app, db.engine)
+    # Reads fall back to the primary, so a replica that is down doesn't
+    # hold the worker back
+    for key in router.replicas:
+        try:
+            _fill_pool(app, db.engines[key])
+        except Exception as e:
+            router.mark_down(key, e)
+            with state._lock:
+                state.warnings.append(f"{key} unreachable: {e}")
+
+
+def _prime_caches(app, deadline):
+    """Wait for the background-loaded caches, up to the warm-up timeout."""
+    rollup.is_ready(db.session)
+    waiting = {
+        "leaderboard": lambda: leaderboard.ready,
+        "film_search": lambda: search_index.ready,
+        "customer_search": lambda: customer_index.ready,
+    }
+    if not app.config.get("LEADERBOARD_ENABLED", True):
+        del waiting["leaderboard"]
+    if not app.config.get("FILM_SEARCH_INDEX_ENABLED", True):
+        del waiting["film_search"]
+    if not app.config.get("CUSTOMER_SEARCH_INDEX_ENABLED", True):
+        del waiting["customer_search"]
+    while waiting and time.perf_counter() < deadline:
+        waiting = {name: ready for name, ready in waiting.items()
+                   if not ready()}
+        time.sleep(0.05)
+    for name in waiting:
+        # Their routes fall back to SQL, so this is not fatal
+        with state._lock:
+            state.warnings.append(f"{name} not loaded within warm-up timeout")
+
+
+def _prime_routes(app):
+    """
+    Request the hot read routes once. This compiles and caches their
+    statements, warms the database's plan and buffer caches and fills the
+    response caches.
+    """
+    client = app.test_client()
+    for path in app.config.get("WARMUP_PATHS", DEFAULT_WARMUP_PATHS):
+        response = client.get(path)
+        if response.status_code >= 500:
+            raise RuntimeError(f"warm-up request {path} failed: "
+                               f"{response.status_code}")
+
+
+def _timed(name, func, *args):
+    started = time.perf_counter()
+    func(*args)
+    state.record(name + "_seconds", time.perf_counter() - started)
+
+
+def _warm_up(app, started):
+    timeout = app.config.get("WARMUP_TIMEOUT_SECONDS",
+                             DEFAULT_WARMUP_TIMEOUT_SECONDS)
+    deadline = time.perf_counter() + timeout
+    while True:
+        with app.app_context():
+            try:
+                _timed("warmup_connections", _open_connections, app)
+                _timed("warmup_caches", _prime_caches, app, deadline)
+                _timed("warmup_requests", _prime_routes, app)
+                break
+            except Exception as e:
+                # Most likely the database is not reachable yet; stay
+                # unready and try again
+                with state._lock:
+                    state.error = str(e)
+                app.logger.warning("warm-up failed: %s", e)
+            finally:
+                db.session.remove()
+        time.sleep(WARMUP_RETRY_SECONDS)
+
+    state.record("warmup_seconds", time.perf_counter() - started)
+    with state._lock:
+        state.ready = True
+        state.error = None
+    app.logger.info("worker ready: %s", state.timings)
+
+
+def start(app):
+    """
+    Start this worker process: its background jobs and the warm-up phase.
+    Call it once per process after any fork; /ready answers 503 until the
+    warm-up has finished.
+    """
+    with state._lock:
+        if state.started:
+            return
+        state.started = True
+    started = time.perf_counter()
+
+    with app.app_context():
+        # Pooled connections inherited from a pre-fork master must not be
+        # shared with it; drop them without closing the master's sockets
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    background.start_all(app)
+
+    if not app.config.get("WARMUP_ENABLED", True):
+        with state._lock:
+            state.ready = True
+        return
+    thread = threading.Thread(target=_warm_up, args=(app, started),
+                              name="warm-up", daemon=True)
+    thread.start()
+
+
+@startup_bp.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: 200 once this worker has warmed up, 503 before."""
+    status = state.status()
+    if status["ready"]:
+        return jsonify(status)
+    response = jsonify(status)
+    response.status_code = 503
+    response.headers["Retry-After"] = str(
+        current_app.config.get("RETRY_AFTER_SECONDS", 1)
+    )
+    return response
+
+
+def init_app(app):
+    """Serve the readiness probe at /ready."""
+    app.register_blueprint(startup_bp)
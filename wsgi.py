@@ -0,0 +1,22 @@
+"""
+WSGI entry point.
+
+    flask --app wsgi run
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Outside a pre-fork master (SAKILA_PREFORK) the worker is started right
+away: background jobs run and warm-up begins.
+"""
+import time
+
+started = time.perf_counter()
+
+from app import create_app  # noqa: E402
+import startup  # noqa: E402
+
+startup.state.record("import_seconds", time.perf_counter() - started)
+
+app = create_app()
+
+if not app.config.get("PREFORK"):
+    startup.start(app)